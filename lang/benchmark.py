@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# Micro benchmark of ugettext/ungettext, compares the precompiled catalogs
+# with the linear table scan and per call cookie parsing they replaced.
+# Run from the project root: python -m lang.benchmark
+import os
+import re
+import Cookie
+import timeit
+
+from django.utils import simplejson
+from django.utils.encoding import force_unicode
+
+from lib import cc_cookies
+from lib import cc_context
+from lang import language
+from lang.langs_table import lang_table
+
+NUMBER = 10000
+MESSAGES = [u'Are you sure delete this album?', u'Next Photo',
+            u'default photo name is full url path, use url==your_name to custom photo name']
+PLURAL_MESSAGE = u"comment too long, max %0 chars"
+
+def legacy_get_current_lang():
+    cookie = Cookie.SimpleCookie()
+    cookie.load(os.environ.get('HTTP_COOKIE', ''))
+    return simplejson.loads(cookie[language.COOKIE_NAME].value)
+
+def legacy_find_msg_index(msg):
+    for lang in lang_table.keys():
+        index = 0
+        for m in lang_table[lang]:
+            if force_unicode(m) == msg:
+                return index
+            index += 1
+
+def legacy_ugettext(msg):
+    return force_unicode(lang_table[legacy_get_current_lang()][legacy_find_msg_index(msg)])
+
+re_seq = re.compile(r'(?P<replacer>%(?P<seq>\d+))')
+def legacy_ungettext(msg, *argvs):
+    msg = legacy_ugettext(msg)
+    out = []
+    start = 0
+    for match in re_seq.finditer(msg):
+        out.append(msg[start:match.start()])
+        out.append(force_unicode(argvs[long(match.group('seq'))]))
+        start = match.end()
+    out.append(msg[start:])
+    return u"".join(out)
+
+def bench(name, func, *argvs):
+    seconds = min(timeit.repeat(lambda: func(*argvs), number=NUMBER, repeat=3))
+    print("%-24s %8.2f us/call" % (name, seconds * 1000000 / NUMBER))
+
+def main():
+    os.environ['HTTP_COOKIE'] = '%s="%s"' % (language.COOKIE_NAME, simplejson.dumps(u"zh-cn").replace('"', '\\"'))
+    cc_cookies.init_cookies()
+    cc_context.init_context()
+    for msg in MESSAGES:
+        print(msg)
+        bench("  legacy ugettext", legacy_ugettext, msg)
+        bench("  ugettext", language.ugettext, msg)
+    print(PLURAL_MESSAGE)
+    bench("  legacy ungettext", legacy_ungettext, PLURAL_MESSAGE, 140)
+    bench("  ungettext", language.ungettext, PLURAL_MESSAGE, 140)
+
+if __name__ == '__main__':
+    main()
@@ -126,6 +126,16 @@ u"get file content error",
 u"one url per line",
 u"Add photos from urls",
 u"default photo name is full url path, use url==your_name to custom photo name",
+u"Quality",
+u"Incremental Backup",
+u"Manifest",
+u"done",
+u"backup not exist",
+u"no photos changed since last backup",
+u"upload failed",
+u"blob collection not exist",
+u"More Comments",
+u"invalid cursor",
 ],
 
 u"zh-cn":
@@ -254,6 +264,16 @@ u"图片获取错误",
 u"每行一条url",
 u"上传网络图片",
 u"默认使用url路径作为图片名, 你可以使用 url == your_name 这样的格式来自定义图片名",
+u"质量",
+u"增量备份",
+u"清单",
+u"已完成",
+u"备份不存在",
+u"上次备份后没有修改过的照片",
+u"上传失败",
+u"垃圾回收记录不存在",
+u"更多评论",
+u"无效的游标",
 ],
 }
 
@@ -5,13 +5,13 @@ import re
 import logging
 import Cookie
 import time
-from cStringIO import StringIO
 
 from django.utils import simplejson
 from django.utils.encoding import force_unicode
 
 from langs_table import lang_table
 from lib import cc_cookies
+from lib import cc_context
 
 DEFAULT_LANG = 'en-us'
 COOKIE_NAME = 'gaephotos-language'
@@ -19,7 +19,7 @@ COOKIE_NAME = 'gaephotos-language'
 def get_support_langs():
     return lang_table.keys()
 
-def get_current_lang():
+def _resolve_current_lang():
     browser_cookie = os.environ.get('HTTP_COOKIE', '')
     cookie = Cookie.SimpleCookie()
     cookie.load(browser_cookie)
@@ -39,6 +39,9 @@ def get_current_lang():
         save_current_lang(lang)
     return lang
 
+def get_current_lang():
+    return cc_context.memoize("lang", _resolve_current_lang)
+
 def save_current_lang(lang):
     if not isinstance(lang, unicode):
         lang = force_unicode(lang)
@@ -51,52 +54,66 @@ def save_current_lang(lang):
     cookie[COOKIE_NAME]['expires'] = now[:-4] + str(int(now[-4:])+1) + ' GMT'
     cookie[COOKIE_NAME]['path'] = '/'
     cc_cookies.add_cookie(cookie)
+    cc_context.set("lang", lang)
     return cookie
 
+def _compile_catalogs(table):
+    # a msgid may be given in any language, the first table containing it wins
+    msg_index = {}
+    for lang in table.keys():
+        for index, m in enumerate(table[lang]):
+            msg_index.setdefault(force_unicode(m), index)
+    catalogs = {}
+    for lang in table.keys():
+        msgs = [force_unicode(m) for m in table[lang]]
+        catalogs[lang] = dict([(msg, msgs[index]) for msg, index in msg_index.iteritems()
+                               if index < len(msgs)])
+    return msg_index, catalogs
+
+_msg_index, _catalogs = _compile_catalogs(lang_table)
+
 def find_msg_index(msg):
     if not isinstance(msg, unicode):
         msg = force_unicode(msg)
-    for lang in lang_table.keys():
-        index = 0
-        for m in lang_table[lang]:
-            if force_unicode(m) == msg:
-                return index
-            index += 1
-
-    raise Exception(u"can not find '%s'"%(msg))
-        
-def ugettext(msg):
-    lang = get_current_lang()
     try:
-        return force_unicode(lang_table[lang][find_msg_index(msg)])
-    except:
-        logging.exception(u'can not found:  %s for %s'%(msg,lang))
-        return force_unicode(msg)
+        return _msg_index[msg]
+    except KeyError:
+        raise Exception(u"can not find '%s'"%(msg))
+
+def translate(msg, lang):
+    if not isinstance(msg, unicode):
+        msg = force_unicode(msg)
+    try:
+        return _catalogs[lang][msg]
+    except KeyError:
+        logging.error(u'can not found:  %s for %s'%(msg,lang))
+        return msg
+
+def ugettext(msg):
+    return translate(msg, get_current_lang())
 
 re_seq = re.compile(r'(?P<replacer>%(?P<seq>\d+))')
+_ungettext_templates = {}
+
+def _compile_template(msg):
+    parts = []
+    start = 0
+    for match in re_seq.finditer(msg):
+        parts.append((msg[start:match.start()], long(match.group('seq'))))
+        start = match.end()
+    return tuple(parts), msg[start:]
+
 def ungettext(msg, *argvs):
-    lang = get_current_lang()
-    try:
-        msg = force_unicode(lang_table[lang][find_msg_index(msg)])
-    except:
-        logging.exception(u'can not found:  %s for %s'%(msg,lang))
+    msg = translate(msg, get_current_lang())
+    template = _ungettext_templates.get(msg)
+    if template is None:
+        template = _ungettext_templates[msg] = _compile_template(msg)
+    parts, tail = template
     try:
-        seq_iter = re_seq.finditer(msg)
-        newmsg = StringIO()
-        start = 0
-        for match in seq_iter:
-            seq = long(match.group('seq'))
-            span = match.span()
-            newmsg.write( ("%s"%force_unicode(msg[start:span[0]])).encode('utf-8') )
-            newmsg.write( ("%s"%force_unicode(argvs[seq])).encode('utf-8') )
-            start = span[1]
-        newmsg.write( ("%s"%force_unicode(msg[start:])).encode('utf-8') )
-        msg = newmsg.getvalue()
-        newmsg.close()
-        return force_unicode(msg)
+        return u"".join([text + force_unicode(argvs[seq]) for text, seq in parts]) + tail
     except:
         logging.exception(u'translate error: %s'%msg)
-    return force_unicode(msg)
+    return msg
     
 _ = ugettext
 _m = ungettext
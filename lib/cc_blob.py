@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+import time
+import itertools
+from collections import deque
+
+from google.appengine.ext import blobstore
+
+class BlobPrefetcher(object):
+    "Reads blobs in order, keeping async fetch_data rpcs in flight ahead of the consumer"
+    def __init__(self, blobs, max_rpcs=8, max_bytes=8*1024*1024, chunk_size=blobstore.MAX_BLOB_FETCH_SIZE):
+        """blobs is a list of (blob_key, size), at most max_rpcs chunks and max_bytes
+        are fetched but not consumed yet. The first chunk is always allowed."""
+        self.blobs = list(blobs)
+        self.max_rpcs = max_rpcs
+        self.max_bytes = max_bytes
+        self.chunk_size = min(chunk_size, blobstore.MAX_BLOB_FETCH_SIZE)
+        self.bytes = 0
+        self.rpcs = 0
+        self.wait_time = 0.0
+        self.start_time = None
+        self.end_time = None
+
+    def _chunk_count(self, size):
+        return (size + self.chunk_size - 1) // self.chunk_size
+
+    def _ranges(self):
+        for blob_key, size in self.blobs:
+            for start in xrange(0, size, self.chunk_size):
+                yield blob_key, start, min(start + self.chunk_size, size) - 1
+
+    def _fetch(self):
+        ranges = self._ranges()
+        next_range = next(ranges, None)
+        in_flight = deque()
+        in_flight_bytes = 0
+        self.start_time = time.time()
+        while next_range or in_flight:
+            while next_range and len(in_flight) < self.max_rpcs:
+                blob_key, start, end = next_range
+                size = end - start + 1
+                if in_flight and in_flight_bytes + size > self.max_bytes:
+                    break
+                in_flight.append((size, blobstore.fetch_data_async(blob_key, start, end)))
+                in_flight_bytes += size
+                self.rpcs += 1
+                next_range = next(ranges, None)
+            size, rpc = in_flight.popleft()
+            wait_start = time.time()
+            data = rpc.get_result()
+            self.wait_time += time.time() - wait_start
+            in_flight_bytes -= size
+            self.bytes += len(data)
+            yield data
+
+    def __iter__(self):
+        """Yields (blob_key, chunks) in the given order, chunks left unread are skipped."""
+        chunks = self._fetch()
+        for blob_key, size in self.blobs:
+            blob_chunks = itertools.islice(chunks, self._chunk_count(size))
+            yield blob_key, blob_chunks
+            for chunk in blob_chunks:
+                pass
+        self.end_time = time.time()
+
+    def stats(self):
+        elapsed = ((self.end_time or time.time()) - self.start_time) if self.start_time else 0.0
+        return {"blobs": len(self.blobs),
+                "bytes": self.bytes,
+                "rpcs": self.rpcs,
+                "seconds": elapsed,
+                "wait_seconds": self.wait_time,
+                "bytes_per_second": elapsed and self.bytes / elapsed or 0.0}
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+
+_MISSING = object()
+
+class LRUCache(object):
+    "Thread-safe LRU cache bounded by entry count and approximate bytes, with optional TTL"
+    def __init__(self, max_entries=1000, max_bytes=16*1024*1024, ttl=None, sizeof=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof or sys.getsizeof
+        self._lock = threading.RLock()
+        self._data = OrderedDict()  # key -> (value, size, expires), oldest first
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def _pop(self, key):
+        value, size, expires = self._data.pop(key)
+        self._bytes -= size
+        return value
+
+    def _get(self, key, now):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return _MISSING
+        if item[2] is not None and item[2] <= now:
+            self._pop(key)
+            self.misses += 1
+            self.evictions += 1
+            return _MISSING
+        # move to the most recently used end
+        del self._data[key]
+        self._data[key] = item
+        self.hits += 1
+        return item[0]
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._get(key, time.time())
+        if value is _MISSING:
+            return default
+        return value
+
+    def get_multi(self, keys):
+        """Returns a dict of the cached keys, missing or expired keys are left out."""
+        ret = {}
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                value = self._get(key, now)
+                if value is not _MISSING:
+                    ret[key] = value
+        return ret
+
+    def set(self, key, value, size=None):
+        if size is None:
+            size = self.sizeof(value)
+        if size > self.max_bytes:
+            self.delete(key)
+            return False
+        expires = self.ttl and (time.time() + self.ttl) or None
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            self._data[key] = (value, size, expires)
+            self._bytes += size
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                old_key, old_item = self._data.popitem(last=False)
+                self._bytes -= old_item[1]
+                self.evictions += 1
+        return True
+
+    def set_multi(self, mapping, sizes=None):
+        sizes = sizes or {}
+        for key, value in mapping.iteritems():
+            self.set(key, value, sizes.get(key))
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._data:
+                return self._pop(key)
+
+    def delete_multi(self, keys):
+        with self._lock:
+            return [self._pop(key) for key in keys if key in self._data]
+
+    def delete_if(self, predicate):
+        with self._lock:
+            return [self._pop(key) for key in self._data.keys() if predicate(key)]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._data),
+                    "bytes": self._bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions}
+
+
+def _generation_seed():
+    # a re-seeded counter must not repeat a value seen before it was evicted
+    return long(time.time() * 1000)
+
+class GenerationCounters(object):
+    "Generation counters shared through memcache, synced into this instance once per request"
+    def __init__(self, key_prefix="generation_"):
+        self.key_prefix = key_prefix
+        self._lock = threading.Lock()
+        self._seen = {}
+
+    def get(self, name):
+        return self._seen.get(name, 0)
+
+    def bump(self, *names):
+        for name in names:
+            value = memcache.incr(self.key_prefix + name, initial_value=_generation_seed())
+            if value is None:
+                continue
+            with self._lock:
+                # our own write, no need to treat it as a change on the next sync
+                if self._seen.get(name) == value - 1:
+                    self._seen[name] = value
+
+    def sync(self, names):
+        """Fetches the counters with one get_multi and returns the names changed since the last sync."""
+        values = memcache.get_multi(names, key_prefix=self.key_prefix)
+        missing = dict((name, _generation_seed()) for name in names if name not in values)
+        if missing:
+            memcache.add_multi(missing, key_prefix=self.key_prefix)
+            values.update(missing)
+        with self._lock:
+            changed = [name for name in names if self._seen.get(name) != values[name]]
+            self._seen.update(values)
+        return changed
+
+
+class CacheNamespaces(object):
+    "Versioned memcache key families, invalidating a family leaves its old keys to age out"
+    def __init__(self, generations, families):
+        self.generations = generations
+        self.families = list(families)
+
+    def key(self, family, *parts):
+        return "%s_%d_%s" % (family, self.generations.get(family), "_".join(parts))
+
+    def invalidate(self, *families):
+        self.generations.bump(*families)
+
+
+class CCCacheSyncWSGIMiddleware(object):
+    "WSGI Middleware syncing cache generations before each request"
+    def __init__(self, app, sync):
+        self.app = app
+        self.sync = sync
+
+    def __call__(self, environ, start_response):
+        try:
+            self.sync()
+        except Exception:
+            logging.exception("sync cache generations")
+        return self.app(environ, start_response)
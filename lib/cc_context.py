@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+_local_context = threading.local()
+
+def init_context():
+    """Init the context associated with the current request."""
+    _local_context._values = {}
+
+def clear_context():
+    """Clear the context associated with the current request."""
+    _local_context._values = {}
+
+def _values():
+    if not hasattr(_local_context, "_values"):
+        init_context()
+    return _local_context._values
+
+def get(name, default=None):
+    """Gets a value of the current request."""
+    return _values().get(name, default)
+
+def set(name, value):
+    """Sets a value of the current request."""
+    _values()[name] = value
+    return value
+
+def memoize(name, func, *args, **kwds):
+    """Calls func once per request and returns the remembered result afterwards."""
+    values = _values()
+    if name not in values:
+        values[name] = func(*args, **kwds)
+    return values[name]
+
+class CCContextWSGIMiddleware(object):
+    "WSGI Middleware handle request context"
+    def __init__(self, app):
+        self.app = app
+        init_context()
+
+    def __call__(self, environ, start_response):
+        clear_context()
+        return self.app(environ, start_response)
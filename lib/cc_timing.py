@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+from contextlib import contextmanager
+
+class RequestTimer(object):
+    "Timing breakdown of one request, logged and sent as a Server-Timing header to admins"
+    def __init__(self, name):
+        self.name = name
+        self.start_time = time.time()
+        self.spans = []
+
+    @contextmanager
+    def span(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.spans.append((name, time.time() - start))
+
+    def total(self):
+        return time.time() - self.start_time
+
+    def header(self):
+        spans = self.spans + [("total", self.total())]
+        return ", ".join(["%s;dur=%.1f" % (name, seconds * 1000) for name, seconds in spans])
+
+    def log(self):
+        logging.info("%s timing: %s", self.name,
+                     " ".join(["%s=%.1fms" % (name, seconds * 1000) for name, seconds in self.spans]
+                              + ["total=%.1fms" % (self.total() * 1000)]))
+
+    def finish(self, response, send_header=False):
+        """Logs the breakdown, the header is only sent when send_header, it tells
+        anyone how long the queries behind the page take."""
+        if send_header:
+            response.headers["Server-Timing"] = self.header()
+        self.log()
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+import time
+import zlib
+import struct
+import zipfile
+
+_FLAG_DATA_DESCRIPTOR = 0x08
+_FLAG_UTF8 = 0x800
+_DATA_DESCRIPTOR = "PK\x07\x08"
+_VERSION = 20
+
+def _dos_date_time(timestamp=None):
+    t = time.localtime(timestamp)
+    dosdate = (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+    dostime = t.tm_hour << 11 | t.tm_min << 5 | (t.tm_sec // 2)
+    return dosdate, dostime
+
+class ZipStream(object):
+    "Zip archive written as a sequence of chunks, only the central directory is kept in memory"
+    def __init__(self):
+        self._entries = []
+        self._offset = 0
+
+    def _encode_name(self, name):
+        if isinstance(name, unicode):
+            try:
+                return name.encode("ascii"), 0
+            except UnicodeEncodeError:
+                return name.encode("utf-8"), _FLAG_UTF8
+        return name, 0
+
+    def write(self, name, chunks, compress=True, timestamp=None):
+        """Yields the local header, the data of chunks and the data descriptor of one entry.
+        Stored entries are read into memory first, their local header carries the crc and
+        the size, some unzip tools cannot read stored entries with a data descriptor."""
+        if not compress:
+            for chunk in self._write_stored(name, list(chunks), timestamp):
+                yield chunk
+            return
+        filename, flags = self._encode_name(name)
+        flags |= _FLAG_DATA_DESCRIPTOR
+        method = zipfile.ZIP_DEFLATED
+        dosdate, dostime = _dos_date_time(timestamp)
+        header = struct.pack(zipfile.structFileHeader, zipfile.stringFileHeader,
+                             _VERSION, 0, flags, method, dostime, dosdate,
+                             0, 0, 0, len(filename), 0)
+        entry = {"filename": filename, "flags": flags, "method": method,
+                 "dostime": dostime, "dosdate": dosdate, "offset": self._offset}
+        self._offset += len(header) + len(filename)
+        yield header + filename
+
+        crc = 0
+        file_size = compress_size = 0
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            chunk = compressor.compress(chunk)
+            if chunk:
+                compress_size += len(chunk)
+                yield chunk
+        chunk = compressor.flush()
+        compress_size += len(chunk)
+        yield chunk
+
+        entry.update(crc=crc & 0xffffffff, file_size=file_size, compress_size=compress_size)
+        self._entries.append(entry)
+        descriptor = struct.pack("<4sLLL", _DATA_DESCRIPTOR, entry["crc"], compress_size, file_size)
+        self._offset += compress_size + len(descriptor)
+        yield descriptor
+
+    def _write_stored(self, name, chunks, timestamp):
+        filename, flags = self._encode_name(name)
+        dosdate, dostime = _dos_date_time(timestamp)
+        crc = 0
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+        crc &= 0xffffffff
+        file_size = sum([len(chunk) for chunk in chunks])
+        header = struct.pack(zipfile.structFileHeader, zipfile.stringFileHeader,
+                             _VERSION, 0, flags, zipfile.ZIP_STORED, dostime, dosdate,
+                             crc, file_size, file_size, len(filename), 0)
+        self._entries.append({"filename": filename, "flags": flags, "method": zipfile.ZIP_STORED,
+                              "dostime": dostime, "dosdate": dosdate, "offset": self._offset,
+                              "crc": crc, "file_size": file_size, "compress_size": file_size})
+        self._offset += len(header) + len(filename) + file_size
+        yield header + filename
+        for chunk in chunks:
+            if chunk:
+                yield chunk
+
+    def close(self):
+        """Yields the central directory and the end of archive record."""
+        start = self._offset
+        size = 0
+        for entry in self._entries:
+            record = struct.pack(zipfile.structCentralDir, zipfile.stringCentralDir,
+                                 _VERSION, 0, _VERSION, 0, entry["flags"], entry["method"],
+                                 entry["dostime"], entry["dosdate"], entry["crc"],
+                                 entry["compress_size"], entry["file_size"],
+                                 len(entry["filename"]), 0, 0, 0, 0, 0, entry["offset"])
+            record += entry["filename"]
+            size += len(record)
+            yield record
+        yield struct.pack(zipfile.structEndArchive, zipfile.stringEndArchive,
+                          0, 0, len(self._entries), len(self._entries), size, start, 0)
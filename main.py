@@ -2,10 +2,12 @@
 import os
 import cgi
 import time
+import hashlib
 import logging
+import urllib
+import itertools
 import jinja2
 import webapp2
-from datetime import datetime
 from webapp2_extras import json
 from functools import wraps
 from django.utils.encoding import force_unicode
@@ -13,6 +15,9 @@ from google.appengine.api import users
 from google.appengine.ext import blobstore
 from google.appengine.api import memcache
 from google.appengine.api import urlfetch
+from google.appengine.api import taskqueue
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore_errors
 from google.appengine.ext.webapp import blobstore_handlers
 
 from google.appengine.api import conf
@@ -24,8 +29,14 @@ else:
 
 import utils
 import model
+from lib import cc_context
 from lib.cc_cookies import CCCookiesWSGIMiddleware
-from lang import save_current_lang
+from lib.cc_context import CCContextWSGIMiddleware
+from lib.cc_cache import CCCacheSyncWSGIMiddleware, LRUCache
+from lib.cc_zip import ZipStream
+from lib.cc_blob import BlobPrefetcher
+from lib.cc_timing import RequestTimer
+from lang import save_current_lang, get_current_lang
 from lang import ugettext, ungettext, ccTranslations
 
 _ = ugettext
@@ -64,22 +75,29 @@ logging.info("init jinja2")
 
 # public classes and functions
 
-def check_admin_auth():
-    if users.is_current_user_admin():
+def get_current_user():
+    return cc_context.memoize("cur_user", users.get_current_user)
+
+
+def _is_site_admin():
+    if check_owner_auth():
         return True
-    user = users.get_current_user()
+    user = get_current_user()
     if not user:
         return False
-    email = user.email()
-    return email in model.SITE_SETTINGS.adminlist
+    return user.email() in model.SITE_SETTINGS.admin_set
+
+
+def check_admin_auth():
+    return cc_context.memoize("is_admin", _is_site_admin)
 
 
 def check_owner_auth():
-    return users.is_current_user_admin()
+    return cc_context.memoize("is_owner", users.is_current_user_admin)
 
 
 def check_login_auth():
-    return users.get_current_user()
+    return get_current_user()
 
 
 def requires_site_owner(method):
@@ -119,14 +137,12 @@ def render_with_user_and_settings(templatename, context={}):
                     "allalbums": get_album_list_from_settings(),
                     "users": {"is_admin": check_admin_auth(),
                               "is_owner": check_owner_auth(),
-                              "cur_user": users.get_current_user()}})
+                              "cur_user": get_current_user()}})
     return template.render(context)
 
 
 def get_album_list_from_settings():
-    if check_admin_auth():
-        return  model.SITE_SETTINGS.AlbumList
-    return [album for album in model.SITE_SETTINGS.AlbumList if album.get("public")]
+    return model.SITE_SETTINGS.album_index.for_user(check_admin_auth())
 
 
 def get_all_albums(pagesize=20, start_cursor=None, order="-createdate"):
@@ -135,6 +151,57 @@ def get_all_albums(pagesize=20, start_cursor=None, order="-createdate"):
     return albums, cursor
 
 
+PAGE_CACHE_TIME = 3600 * 24 # pages of an old content generation are never read again
+PAGE_CACHE_PREFIX = "page_"
+_page_cache = LRUCache(max_entries=200, max_bytes=4*1024*1024, ttl=60)
+
+def page_cache_key(request):
+    """Key of a rendered page, by url, language and content generation."""
+    key = u"%s|%s|%s" % (request.host_url + request.path_qs, get_current_lang(), model.content_generation())
+    return hashlib.md5(key.encode("utf-8")).hexdigest()
+
+def cache_anonymous_page(method):
+    """Serves the get handler from the rendered page cache to visitors who are not logged in,
+    with an ETag and Last-Modified, a matching If-None-Match is answered with 304."""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if get_current_user() or self.request.get("lang"):
+            return method(self, *args, **kwargs)
+        key = page_cache_key(self.request)
+        page = _page_cache.get(key)
+        if page is None:
+            page = memcache.get(PAGE_CACHE_PREFIX + key)
+            if page is not None:
+                _page_cache.set(key, page, len(page["body"]))
+        if page is None:
+            method(self, *args, **kwargs)
+            if self.response.status_int != 200:
+                return
+            body = self.response.body
+            page = {"body": body,
+                    "etag": '"%s"' % hashlib.md5(body).hexdigest(),
+                    "last_modified": utils.http_date(),
+                    "content_type": self.response.headers.get("Content-Type")}
+            _page_cache.set(key, page, len(body))
+            try:
+                memcache.set(PAGE_CACHE_PREFIX + key, page, time=PAGE_CACHE_TIME)
+            except:
+                pass
+        else:
+            self.response.headers["Content-Type"] = page["content_type"]
+            self.response.body = page["body"]
+
+        self.response.headers["ETag"] = page["etag"]
+        self.response.headers["Last-Modified"] = page["last_modified"]
+        self.response.headers["Cache-Control"] = "no-cache"
+        etags = [etag.strip() for etag in self.request.headers.get("If-None-Match", "").split(",")]
+        if page["etag"] in etags or "*" in etags:
+            self.response.set_status(304)
+            self.response.body = ""
+
+    return wrapper
+
+
 class ccRequestHandler(webapp2.RequestHandler):
     def handle_exception(self, exception, debug):
         logging.exception("exception in handler")
@@ -143,103 +210,154 @@ class ccRequestHandler(webapp2.RequestHandler):
 
 class ccPhotoRequestHandler(blobstore_handlers.BlobstoreDownloadHandler):
     CACHE_TIME = 3600 * 24 * 30
+    FALLBACK_CACHE_TIME = 300 # the original served for a derivative which is not rendered yet
     URL_PHOTO_NOT_FOUND = "/static/images/image_not_found.jpg"
     URL_BLOCKED_REFERRER = "/static/images/no_hotlinking.gif"
+    # the slider shows medium, it must not give away the photo without the watermark
+    WATERMARKED_TYPES = ("photo", "medium")
+
+    @staticmethod
+    def photo_cache_key(type, albumname, photoname):
+        if type == "watermark":
+            return model.cache_key("watermark_cache", albumname, photoname)
+        return model.cache_key("photo_cache", type, albumname, photoname)
 
     @staticmethod
-    def delete_photos_cache(albumname, photonames, types=["photo","thumb"]):
+    def delete_photos_cache(albumname, photonames, types=None):
+        if types is None:
+            types = ["photo", "watermark"] + [size[0] for size in model.DERIVATIVE_SIZES]
         cache_keys = []
         for t in types:
             for name in photonames:
-                key = "photo_cache_%s_%s_%s" % (t, albumname, name)
+                key = ccPhotoRequestHandler.photo_cache_key(t, albumname, name)
                 cache_keys.append(key)
         memcache.delete_multi(cache_keys)
 
     @staticmethod
     def get_blob_info_from_cache_or_db(albumname, photoname, type="photo"):
-        key = "photo_cache_%s_%s_%s" % (type, albumname, photoname)
+        """Returns (blob_info, cacheable), cacheable is False for a stand-in which is
+        replaced once the derivative is rendered."""
+        key = ccPhotoRequestHandler.photo_cache_key(type, albumname, photoname)
         blob_info = memcache.get(key)
+        cacheable = True
         if not blob_info:
             photo = model.DBPhoto.get_photo_by_name(albumname, photoname)
             if photo:
                 if type == "photo":
-                    blob_key = photo.blob_key
+                    blob_info = blobstore.get(photo.blob_key)
                 else:
-                    blob_key = photo.thumb_blob_key
-                blob_info = blobstore.get(blob_key)
-                if blob_info:
+                    blob_key = photo.get_derivative_key(type)
+                    blob_info = blob_key and blobstore.get(blob_key)
+                    if blob_key and not blob_info:
+                        # the derivative blob is gone, it is not rendered again on its own
+                        logging.error("derivative %s of %s is missing", type, photo.keyname)
+                        photo.set_derivatives_failed()
+                    if not blob_info:
+                        # not rendered (yet), the original is the best we have, for good once rendering
+                        # failed or when the original is not larger than the derivative
+                        cacheable = (photo.derivative_state == model.DerivativeState.FAILED
+                                     or type not in photo.missing_derivatives)
+                        if type == "thumb2x" and not cacheable and photo.thumb_blob_key:
+                            # until it is rendered a blurry thumb beats downloading the whole original
+                            blob_info = blobstore.get(photo.thumb_blob_key)
+                        blob_info = blob_info or blobstore.get(photo.blob_key)
+                if blob_info and cacheable:
                     try:
-                        memcache.set(key, blob_info)
+                        memcache.set(key, blob_info, time=model.CACHE_FAMILY_TIME)
                     except:
                         pass
-        return blob_info
+        return blob_info, cacheable
 
     @staticmethod
-    def create_watermark(binary, watermark, position=None, opacity=0.4):
-        from google.appengine.api import images
-
-        if position == None:
-            position = images.BOTTOM_RIGHT
-        img = images.Image(binary)
-        width = img.width
-        height = img.height
-        img = images.composite([(img._image_data, 0, 0, 1.0, images.TOP_LEFT),
-            (watermark, 0, 0, opacity, position),
-        ], width, height, 0, images.PNG)
-        return img
-
-
-    def send_blob_with_watermark(self, blob_key_or_info, watermark=""):
-        if isinstance(blob_key_or_info, blobstore.BlobInfo):
-            blob_key = blob_key_or_info.key()
-            blob_info = blob_key_or_info
+    def get_watermark_blob_info(albumname, photoname):
+        key = ccPhotoRequestHandler.photo_cache_key("watermark", albumname, photoname)
+        blob_info = memcache.get(key)
+        if blob_info:
+            return blob_info
+        photo = model.DBPhoto.get_photo_by_name(albumname, photoname)
+        if not photo:
+            return None
+        if photo.watermark_ready:
+            blob_key = photo.watermark_blob_key
         else:
-            blob_key = blob_key_or_info
-            blob_info = blobstore.get(blob_key)
-
-        if not blob_info:
-            self.redirect(self.URL_PHOTO_NOT_FOUND)
-
-        key = "blob_cache_%s_%s" % (blob_key, watermark)
-        image_data = memcache.get(key)
-        if not image_data:
-            blob_reader = blobstore.BlobReader(blob_key)
-            image_data = ccPhotoRequestHandler.create_watermark(
-                blob_reader.read(),
-                watermark=model.SITE_SETTINGS.watermark_img,
-                position=model.SITE_SETTINGS.watermark_position,
-                opacity=model.SITE_SETTINGS.watermark_opacity
-                )
-            blob_reader.close()
-            if image_data:
-                try:
-                    memcache.set(key, image_data)
-                except:
-                    pass
-            else:
-                self.redirect(self.URL_PHOTO_NOT_FOUND)
+            blob_key = photo.render_watermark()
+        blob_info = blobstore.get(blob_key)
+        if blob_info:
+            try:
+                memcache.set(key, blob_info, time=model.CACHE_FAMILY_TIME)
+            except:
+                pass
+        return blob_info
 
-        self.response.headers['Content-Type'] = utils.ImageMime.PNG
-        self.response.out.write(image_data)
+    @staticmethod
+    def photo_validators(blob_info, watermark=False):
+        """ETag and Last-Modified of a blob, a watermarked photo also changes with the watermark settings."""
+        etag = str(blob_info.key())
+        if watermark:
+            etag += "-w%d" % model.SITE_SETTINGS.watermark_version
+        return '"%s"' % etag, blob_info.creation
+
+    def etag_matches(self, etag):
+        if_none_match = self.request.headers.get("If-None-Match")
+        return bool(if_none_match) and etag in [value.strip() for value in if_none_match.split(",")]
+
+    def is_not_modified(self, etag, last_modified):
+        if_none_match = self.request.headers.get("If-None-Match")
+        if if_none_match:
+            return self.etag_matches(etag) or if_none_match.strip() == "*"
+        if_modified_since = self.request.if_modified_since
+        if if_modified_since and last_modified:
+            return last_modified.replace(microsecond=0) <= if_modified_since.replace(tzinfo=None)
+        return False
 
+    def set_cache_headers(self, etag, last_modified, cache_time=None):
+        cache_time = cache_time or self.CACHE_TIME
+        self.response.headers['Date'] = utils.http_date()
+        self.response.headers['Cache-Control'] = 'max-age=%d, public' % cache_time
+        self.response.headers['Expires'] = utils.http_date(time.time() + cache_time)
+        self.response.headers['ETag'] = etag
+        if last_modified:
+            self.response.headers['Last-Modified'] = utils.http_date(last_modified)
 
     def send_photo(self, album_name, photo_name, photo_type):
         if self.check_referrer() == False:
             self.redirect(self.URL_BLOCKED_REFERRER)
+            return
+
+        watermark = photo_type in self.WATERMARKED_TYPES and model.SITE_SETTINGS.enable_watermark
+        if self.request.headers.get("If-None-Match"):
+            # the etag holds the blob key, a matching one can only come from an earlier response
+            # to a permitted request, answer before looking up the album or the blob. A date
+            # can be guessed, If-Modified-Since waits for the album check below
+            blob_info = memcache.get(self.photo_cache_key(watermark and "watermark" or photo_type,
+                                                          album_name, photo_name))
+            if blob_info:
+                etag, last_modified = self.photo_validators(blob_info, watermark)
+                if self.etag_matches(etag):
+                    self.set_cache_headers(etag, last_modified)
+                    self.response.set_status(304)
+                    return
 
         album = model.DBAlbum.get_album_by_name(album_name)
         if not album or (not album.public and not check_admin_auth()):
             self.redirect(self.URL_PHOTO_NOT_FOUND)
+            return
 
-        blob_info = ccPhotoRequestHandler.get_blob_info_from_cache_or_db(album_name, photo_name, photo_type)
+        cacheable = True
+        if watermark:
+            blob_info = ccPhotoRequestHandler.get_watermark_blob_info(album_name, photo_name)
+        else:
+            blob_info, cacheable = ccPhotoRequestHandler.get_blob_info_from_cache_or_db(album_name, photo_name,
+                                                                                        photo_type)
         if blob_info:
-            self.response.headers['Date'] = utils.http_date()
-            self.response.headers['Cache-Control'] = 'max-age=%d, public' % self.CACHE_TIME
-            self.response.headers['Expires'] = utils.http_date(time.time() + self.CACHE_TIME)
-            if photo_type == "photo" and model.SITE_SETTINGS.enable_watermark:
-                self.send_blob_with_watermark(blob_info, model.SITE_SETTINGS.watermark)
-            else:
-                self.send_blob(blob_info)
+            etag, last_modified = self.photo_validators(blob_info, watermark)
+            # browsers and proxies must come back for the derivative once it is rendered
+            self.set_cache_headers(etag, last_modified,
+                                   cache_time=not cacheable and self.FALLBACK_CACHE_TIME or None)
+            if self.is_not_modified(etag, last_modified):
+                self.response.set_status(304)
+                return
+            self.send_blob(blob_info)
         else:
             self.redirect(self.URL_PHOTO_NOT_FOUND)
             #self.error(404)
@@ -273,12 +391,24 @@ def ajax_delete_album(album_name):
     res = ERROR_RES.copy()
     album = model.DBAlbum.get_album_by_name(album_name)
     if album:
-        album.remove()
+        album = album.remove()
         res["status"] = "ok"
+        res["delete_status"] = album.to_delete_status()
     else:
         res["error"] = _("album not exist")
     return res
 
+@requires_site_owner
+def ajax_get_album_delete_status(album_name):
+    res = ERROR_RES.copy()
+    album = model.DBAlbum.get_deleting_album(album_name)
+    if album:
+        res["delete_status"] = album.to_delete_status()
+    else:
+        res["delete_status"] = {"album_name": album_name, "state": "deleted"}
+    res["status"] = "ok"
+    return res
+
 MAX_ALBUM_NAME = 30
 MAX_DESCRIPTION = 50
 MAX_COMMENT = 140
@@ -308,7 +438,7 @@ def ajax_create_album(name, description="description", public=True):
     if album:
         res["error"] = _("album name already exists")
     else:
-        album = model.DBAlbum.create(name, description, bool(public), owner=users.get_current_user())
+        album = model.DBAlbum.create(name, description, bool(public), owner=get_current_user())
         res.update(album.to_dict())
         res["status"] = "ok"
     return res
@@ -318,8 +448,9 @@ def ajax_get_all_albums(pagesize=20, albums_cursor=None, order="-createdate"):
     res = ERROR_RES.copy()
     pagesize = long(pagesize)
     albums, cursor = get_all_albums(pagesize, albums_cursor, order)
+    model.get_comment_counts([album.keyname for album in albums])
     res["cursor"] = cursor
-    res["is_last_page"] = len(albums) < pagesize
+    res["is_last_page"] = cursor is None
     res["albums"] = [ab.to_dict() for ab in albums]
     res["status"] = "ok"
     return res
@@ -336,19 +467,22 @@ def ajax_get_album(album_name):
     return res
 
 
-def ajax_get_album_photos(album_name, start_index=0, pagesize=20):
+def ajax_get_album_photos(album_name, start_index=0, pagesize=20, photos_cursor=None):
     res = ERROR_RES.copy()
     pagesize = long(pagesize)
-    start_index = long(start_index)
+    if not photos_cursor and long(start_index):
+        photos_cursor = "%s%d" % (model.PHOTO_INDEX_CURSOR, long(start_index))
 
     album = model.DBAlbum.get_album_by_name(album_name)
-    if not album:
+    if not album or (not album.public and not check_admin_auth()):
         raise Exception(_("album not exist"))
 
-    photos = model.DBPhoto.get_by_key_name(album.photoslist[start_index:start_index + pagesize])
+    photos, cursor = album.get_photos(pagesize, photos_cursor)
+    model.get_comment_counts([photo.keyname for photo in photos])
 
     res["photos"] = [p.to_dict() for p in photos]
-    res["is_last_page"] = len(photos) < pagesize
+    res["cursor"] = cursor
+    res["is_last_page"] = cursor is None
     res["status"] = "ok"
     return res
 
@@ -412,17 +546,90 @@ def ajax_set_cover_photo(album_name, photo_name):
     return res
 
 
+@requires_site_admin
+def ajax_add_blob_photos(album_name, blob_keys):
+    res = ERROR_RES.copy()
+    album = model.DBAlbum.get_album_by_name(album_name)
+    if not album:
+        res["error"] = _("album not exist")
+        return res
+    blob_keys = [key.strip() for key in blob_keys.split(",") if key.strip()]
+    if not blob_keys:
+        raise Exception(_("no upload file"))
+
+    errors = []
+    uploads = []
+    for blob_key, blob_info in zip(blob_keys, blobstore.BlobInfo.get(blob_keys)):
+        if blob_info:
+            uploads.append((blob_info.filename, blob_info))
+        else:
+            errors.append((blob_key, _("no upload file")))
+    # the blobs may be in use elsewhere, never delete them here
+    photos, upload_errors = add_uploaded_photos(album, uploads, delete_unused=False, owner=get_current_user())
+    model.get_comment_counts([photo.keyname for photo in photos])
+    res["status"] = "ok"
+    res["photos"] = [photo.to_dict() for photo in photos]
+    res["errors"] = errors + upload_errors
+    return res
+
 @requires_site_admin
 def ajax_get_upload_url():
     res = ERROR_RES.copy()
     res["status"] = "ok"
-    res["upload_url"] = blobstore.create_upload_url("/admin/blobupload/")
+    res["upload_url"] = blobstore.create_upload_url("/admin/blobupload/",
+        max_bytes_per_blob=long(model.SITE_SETTINGS.max_upload_size * 1024 * 1024))
     return res
 
+@requires_site_owner
+def ajax_collect_blobs(dry_run=True):
+    res = ERROR_RES.copy()
+    dry_run = dry_run not in (False, "false", "0", "")
+    res["collection"] = model.DBBlobCollection.start(dry_run).to_dict()
+    res["status"] = "ok"
+    return res
+
+@requires_site_owner
+def ajax_get_blob_collection(collection_id):
+    res = ERROR_RES.copy()
+    collection = model.DBBlobCollection.get_collection(collection_id)
+    if collection:
+        res["collection"] = collection.to_dict()
+        res["status"] = "ok"
+    else:
+        res["error"] = _("blob collection not exist")
+    return res
+
+
+COMMENTS_PAGE_SIZE = 20
+COMMENTS_FIRST_PAGE_MAX = COMMENTS_PAGE_SIZE * 2 # written through comments before the page is queried again
+COMMENTS_CAS_RETRIES = 3
+
+def comments_cache_key(album_name, photo_name, is_admin, comments_cursor=""):
+    """Key of a cached page of comments, the first page has an empty cursor."""
+    return model.cache_key("comment", album_name, photo_name, is_admin and "admin" or "public", comments_cursor)
+
+def delete_comments_cache(album_name, photo_name):
+    """Deletes the first pages, the cursors of the next pages change with them."""
+    memcache.delete_multi([comments_cache_key(album_name, photo_name, is_admin) for is_admin in (True, False)])
+
+def write_through_comment(key, comment):
+    """Adds a new comment on top of a cached first page, its next page cursor stays valid
+    as the page only grows. A page grown too large is dropped and queried again."""
+    client = memcache.Client()
+    for i in xrange(COMMENTS_CAS_RETRIES):
+        page = client.gets(key)
+        if page is None:
+            return
+        if len(page["comments"]) >= COMMENTS_FIRST_PAGE_MAX:
+            break
+        page["comments"].insert(0, comment)
+        if client.cas(key, page, time=model.CACHE_FAMILY_TIME):
+            return
+    memcache.delete(key)
 
 def ajax_create_comment(album_name, photo_name, comment, author):
     res = ERROR_RES.copy()
-    user = users.get_current_user()
+    user = get_current_user()
     if model.SITE_SETTINGS.enable_anonymous_comment:
         email = user and user.email() or "anonymous@unknown.com"
         author = cgi.escape(author.strip())
@@ -444,10 +651,11 @@ def ajax_create_comment(album_name, photo_name, comment, author):
 
     comment = model.DBComment.create(album_name, photo_name, comment, author=author, email=email)
 
-    key = "comment_%s_%s"%(album_name, photo_name)
-    memcache.delete(key)
-    res["status"] = "ok"
     res["comment"] = comment.to_dict()
+    for is_admin in (True, False):
+        if is_admin or comment.public:
+            write_through_comment(comments_cache_key(album_name, photo_name, is_admin), res["comment"])
+    res["status"] = "ok"
     return res
 
 
@@ -455,44 +663,56 @@ def ajax_create_comment(album_name, photo_name, comment, author):
 def ajax_delete_comments(album_name, photo_name):
     res = ERROR_RES.copy()
     model.DBComment.del_comments(album_name, photo_name)
-    key = "comment_%s_%s"%(album_name, photo_name)
-    memcache.delete(key)
+    delete_comments_cache(album_name, photo_name)
     res["status"] = "ok"
     return res
 
 @requires_site_owner
 def ajax_delete_comment_by_id(comment_id):
     res = ERROR_RES.copy()
-    comment_id = long(comment_id)
     result = model.DBComment.del_comment_by_id(comment_id)
     if result:
         album_name = result[0]
         photo_name = result[1]
-        key = "comment_%s_%s"%(album_name, photo_name)
-        memcache.delete(key)
+        delete_comments_cache(album_name, photo_name)
         res["status"] = "ok"
     else:
         res["error"] = _("comment not exist")
     return res
 
-def ajax_get_comments(album_name, photo_name):
+def ajax_get_comments(album_name, photo_name, comments_cursor=""):
+    """Returns a page of comments, newest first. The cursor of the next page starts with
+    the version of the first page, a rebuilt first page leads to new cached pages."""
     res = ERROR_RES.copy()
-    key = "comment_%s_%s"%(album_name, photo_name)
-    comments = memcache.get(key)
-    if not comments:
-        if check_admin_auth():
-            comments = model.DBComment.get_comments(album_name, photo_name)
-        else:
-            comments = model.DBComment.get_comments(album_name, photo_name, public=True)
-        comments = [comment.to_dict() for comment in comments]
+    is_admin = check_admin_auth()
+    key = comments_cache_key(album_name, photo_name, is_admin, comments_cursor)
+    page = memcache.get(key)
+    if page is None:
+        try:
+            if comments_cursor:
+                version, cursor = comments_cursor.split(":", 1)
+                long(version, 16)
+            else:
+                version, cursor = "%x" % long(time.time() * 1000), None
+            comments, cursor = model.DBComment.get_comments_page(album_name, photo_name, public=not is_admin,
+                                                                 pagesize=COMMENTS_PAGE_SIZE, cursor=cursor)
+        except (ValueError, datastore_errors.BadValueError, datastore_errors.BadRequestError):
+            res["error"] = _("invalid cursor")
+            return res
+        page = {"comments": [comment.to_dict() for comment in comments],
+                "cursor": cursor and "%s:%s" % (version, cursor) or ""}
         try:
-            memcache.set(key, comments)
+            memcache.set(key, page, time=model.CACHE_FAMILY_TIME)
         except:
             pass
     res["status"] = "ok"
-    res["comments"] = comments
+    res["comments"] = page["comments"]
+    res["cursor"] = page["cursor"]
     return res
 
+WEB_PHOTO_FETCH_CONCURRENCY = 8
+WEB_PHOTO_FETCH_TIMEOUT = 15 # seconds, per url
+
 @requires_site_admin
 def ajax_add_web_photos(album_name, web_links):
     from urlparse import urlparse
@@ -517,6 +737,7 @@ def ajax_add_web_photos(album_name, web_links):
 
     photos = []
     errors = []
+    requests = []
     for link in links:
         url = link[0]
         try:
@@ -526,25 +747,60 @@ def ajax_add_web_photos(album_name, web_links):
                 file_name = link[1].strip()
             else:
                 file_name = "".join(urlparse(url)[1:3]).replace("/", "_")
-            photo = model.DBPhoto.get_photo_by_name(album_name, file_name)
-            if photo:
-                album.add_photo_to_album(photo)
-                raise Exception(_("photo already exists in this album"))
+            requests.append((url, file_name))
+        except Exception,e:
+            errors.append((url, force_unicode(e)))
 
-            result = urlfetch.fetch(url)
+    # one batch get for the existence checks
+    key_names = [model.DBPhoto.gen_key_name(album_name=album_name, photo_name=file_name)
+                 for url, file_name in requests]
+    existing = key_names and model.DBPhoto.get_by_key_name(key_names) or []
+    queue = []
+    file_names = set()
+    for (url, file_name), photo in zip(requests, existing):
+        if photo or file_name in file_names:
+            errors.append((url, _("photo already exists in this album")))
+        else:
+            file_names.add(file_name)
+            queue.append((url, file_name))
+    queue.reverse()
+
+    # keep up to WEB_PHOTO_FETCH_CONCURRENCY fetches in flight, handle each as soon as it completes
+    in_flight = {}
+    while queue or in_flight:
+        while queue and len(in_flight) < WEB_PHOTO_FETCH_CONCURRENCY:
+            url, file_name = queue.pop()
+            try:
+                rpc = urlfetch.create_rpc(deadline=WEB_PHOTO_FETCH_TIMEOUT)
+                urlfetch.make_fetch_call(rpc, url)
+                in_flight[rpc] = (url, file_name)
+            except Exception,e:
+                errors.append((url, force_unicode(e)))
+        if not in_flight:
+            continue
+        rpc = apiproxy_stub_map.UserRPC.wait_any(in_flight.keys())
+        url, file_name = in_flight.pop(rpc)
+        try:
+            try:
+                result = rpc.get_result()
+            except urlfetch.Error:
+                raise Exception(_("get file content error"))
             if result.status_code != 200:
                 raise Exception(_("get file content error"))
             if len(result.content) > model.SITE_SETTINGS.max_upload_size * 1024 * 1024:
                 raise Exception(_("file size exceeds"))
             if utils.get_img_type(result.content) == utils.ImageMime.UNKNOWN:
                 raise Exception(_("unsupported file type"))
-            photo = model.DBPhoto.create(album_name, file_name, result.content, owner=users.get_current_user(),
+            photo = model.DBPhoto.create(album_name, file_name, result.content, owner=get_current_user(),
                                     public=album.public)
-            album.add_photo_to_album(photo)
             photos.append(photo)
         except Exception,e:
             errors.append((url, force_unicode(e)))
 
+    if photos:
+        album = album.add_photos_to_album(photos)
+
+    model.get_comment_counts([album.keyname] + [p.keyname for p in photos])
     res["status"] = "ok"
     res["album"] = album.to_dict()
     res["photos"] =  [p.to_dict() for p in photos]
@@ -558,7 +814,11 @@ AJAX_METHODS = {
     "get_album": ajax_get_album,
     "save_album": ajax_save_album,
     "delete_album": ajax_delete_album,
+    "get_album_delete_status": ajax_get_album_delete_status,
+    "collect_blobs": ajax_collect_blobs,
+    "get_blob_collection": ajax_get_blob_collection,
     "get_upload_url": ajax_get_upload_url,
+    "add_blob_photos": ajax_add_blob_photos,
     "get_album_photos": ajax_get_album_photos,
     "save_photo": ajax_save_photo,
     "delete_photos": ajax_delete_photos,
@@ -629,9 +889,8 @@ class AdminUploadPage(ccRequestHandler):
 
             photo = model.DBPhoto.get_photo_by_name(album_name, file_name)
             if photo:
-                album.add_photo_to_album(photo)
                 raise Exception(_("photo already exists in this album"))
-            photo = model.DBPhoto.create(album_name, file_name, binary, owner=users.get_current_user(),
+            photo = model.DBPhoto.create(album_name, file_name, binary, owner=get_current_user(),
                                         public=album.public, site=self.request.host_url)
             album.add_photo_to_album(photo)
 
@@ -646,23 +905,123 @@ class AdminUploadPage(ccRequestHandler):
         self.response.out.write(json.encode(result))
 
 
+def add_uploaded_photos(album, uploads, delete_unused=True, **kwds):
+    """uploads is a list of (file_name, blob_info), with delete_unused the blobs which do not
+    become a photo are deleted, also when an error is raised. Returns the created photos and
+    the (file_name, error) list, errors carry the file names as uploaded."""
+    photos = []
+    errors = []
+    accepted = []
+    file_names = {}
+    for file_name, blob_info in uploads:
+        if not file_name:
+            errors.append((file_name, _("no file name")))
+        elif blob_info.size > model.SITE_SETTINGS.max_upload_size * 1024 * 1024:
+            errors.append((file_name, _("file size exceeds")))
+        else:
+            file_names[cgi.escape(file_name)] = file_name
+            accepted.append((cgi.escape(file_name), blob_info))
+    succeeded = False
+    try:
+        if accepted:
+            photos, create_errors = model.DBPhoto.create_from_blobs(album.name, accepted,
+                                                                     public=album.public, **kwds)
+            errors += [(file_names[photo_name], _(error)) for photo_name, error in create_errors]
+        if photos:
+            album.add_photos_to_album(photos)
+        succeeded = True
+    finally:
+        if delete_unused:
+            if not succeeded and accepted:
+                # the photos may have been put before the error, keep the blobs they use
+                photos = filter(None, model.DBPhoto.get_by_key_name(
+                    [model.DBPhoto.gen_key_name(album_name=album.name, photo_name=photo_name)
+                     for photo_name, blob_info in accepted]))
+            created = set([photo.blob_key for photo in photos])
+            unused = [blob_info.key() for file_name, blob_info in uploads if str(blob_info.key()) not in created]
+            if unused:
+                blobstore.delete(unused)
+    return photos, errors
+
+
 class UploadHandler(blobstore_handlers.BlobstoreUploadHandler):
     @requires_site_admin
     def post(self):
-        upload_files = self.get_uploads()
+        result = ERROR_RES.copy()
+        upload_files = self.get_uploads("file")
+        try:
+            if not upload_files:
+                raise Exception(_("no upload file"))
+            album = model.DBAlbum.get_album_by_name(self.request.get("album_name"))
+            if not album:
+                raise Exception(_("album not exist"))
+
+            file_names = self.request.get_all("file_name")
+            if len(file_names) != len(upload_files):
+                file_names = [blob_info.filename for blob_info in upload_files]
+            # from here on add_uploaded_photos deletes the blobs which do not become a photo
+            uploads, upload_files = zip(file_names, upload_files), []
+            photos, errors = add_uploaded_photos(album, uploads,
+                                                 owner=get_current_user(), site=self.request.host_url)
+
+            photo_names = set([photo.photo_name for photo in photos])
+            model.get_comment_counts([photo.keyname for photo in photos])
+            result["status"] = "ok"
+            result["photos"] = [photo.to_dict() for photo in photos]
+            result["file_names"] = [name for name in file_names if cgi.escape(name) in photo_names]
+            result["errors"] = errors
+        except Exception, e:
+            logging.exception("upload file error")
+            if upload_files:
+                blobstore.delete([upload_file.key() for upload_file in upload_files])
+            result["status"] = "error"
+            result["error"] = force_unicode(e)
+
+        self.response.out.write(json.encode(result))
 
 
 GAE_RESPONSE_LIMIT = 30*1024*1024 # 30 M
 
-def create_zipfile_from_photos(photos):
-    import zipfile
-    from cStringIO import StringIO
-    buf = StringIO()
-    zfile = zipfile.ZipFile(buf, "w")
-    for photo in photos:
-        zfile.writestr(photo.photo_name, blobstore.BlobReader(photo.blob_key).read(), zipfile.ZIP_DEFLATED)
-    zfile.close()
-    return buf.getvalue()
+ZIP_PREFETCH_RPCS = 8
+ZIP_PREFETCH_BYTES = 8*1024*1024
+# already compressed, deflating them only costs cpu
+ZIP_STORED_MIMES = [utils.ImageMime.JPEG, utils.ImageMime.PNG, utils.ImageMime.GIF]
+
+def create_zipfile_from_photos(photos, on_finish=None):
+    """Generates the zip archive of photos chunk by chunk, to be used as a response app_iter."""
+    zfile = ZipStream()
+    fetcher = BlobPrefetcher([(photo.blob_key, photo.size) for photo in photos],
+                             max_rpcs=ZIP_PREFETCH_RPCS, max_bytes=ZIP_PREFETCH_BYTES)
+    for photo, (blob_key, chunks) in itertools.izip(photos, fetcher):
+        timestamp = time.mktime(photo.createdate.timetuple())
+        for chunk in zfile.write(photo.photo_name, chunks,
+                                 compress=photo.mime not in ZIP_STORED_MIMES, timestamp=timestamp):
+            yield chunk
+    for chunk in zfile.close():
+        yield chunk
+    logging.info("zip blob fetch stats: %s", fetcher.stats())
+    if on_finish:
+        on_finish()
+
+def send_zipfile_from_photos(response, name, photos, on_finish=None):
+    response.headers["Content-Type"] = "application/zip"
+    response.headers["Content-Disposition"]= "attachment;filename=%s.zip"%name.encode("utf-8")
+    response.app_iter = create_zipfile_from_photos(photos, on_finish=on_finish)
+
+def get_backup_part_url(backup, part):
+    return "/admin/zipphotos/?%s" % urllib.urlencode({"album": backup.album_name.encode("utf-8"),
+                                                      "backup": backup.backup_id, "part": part})
+
+def get_backup_manifest_url(backup):
+    return "/admin/download/%s/?%s" % (urllib.quote(backup.album_name.encode("utf-8")),
+                                       urllib.urlencode({"backup": backup.backup_id, "manifest": 1}))
+
+def send_backup_part(response, backup, part):
+    name = u"%s.%s" % (backup.album_name, backup.backup_id)
+    if len(backup.parts) > 1:
+        name += u".part%d" % (part + 1)
+    send_zipfile_from_photos(response, name, backup.get_part_photos(part),
+                             on_finish=lambda: backup.finish_part(part))
 
 class AdminDownloadAlbum(ccRequestHandler):
     @requires_site_admin
@@ -671,57 +1030,53 @@ class AdminDownloadAlbum(ccRequestHandler):
         album = model.DBAlbum.get_album_by_name(albumname)
         if not album:
             raise Exception(_("album not exist"))
-        photos = model.DBPhoto.get_by_key_name(album.photoslist)
-
-        totalsize = sum([photo.size for photo in photos])
-        if totalsize <= 0:
-            raise Exception(_("photo not exist"))
-        if totalsize < GAE_RESPONSE_LIMIT:
-            self.response.headers["Content-Type"] = "application/zip"
-            self.response.headers["Content-Disposition"]= "attachment;filename=%s.zip"%album.name.encode("utf-8")
-            self.response.out.write(create_zipfile_from_photos(photos))
-            model.DBAlbum.set_last_backup_time(albumname, datetime.now())
+
+        backup_id = self.request.get("backup")
+        if backup_id:
+            # resume a backup, the parts already downloaded are marked done
+            backup = model.DBBackup.get_backup(albumname, backup_id)
+            if not backup:
+                raise Exception(_("backup not exist"))
         else:
-            photo_keyname_list = []
-            part = []
-            totalsize = 0
-            for photo in photos:
-                totalsize += photo.size
-                if totalsize < GAE_RESPONSE_LIMIT:
-                    part.append(photo.keyname)
-                else:
-                    photo_keyname_list.append(",".join(part))
-                    totalsize = photo.size
-                    part = [photo.keyname]
-            else:
-                photo_keyname_list.append(",".join(part))
-                
+            incremental = bool(self.request.get("incremental"))
+            backup = model.DBBackup.create(album, incremental=incremental, part_size=GAE_RESPONSE_LIMIT)
+            if not backup:
+                if incremental:
+                    raise Exception(_("no photos changed since last backup"))
+                raise Exception(_("photo not exist"))
+
+        if self.request.get("manifest"):
+            manifest = backup.to_dict()
+            for part in manifest["parts"]:
+                part["url"] = get_backup_part_url(backup, part["part"])
+            self.response.headers["Content-Type"] = "application/json"
+            self.response.out.write(json.encode(manifest))
+        elif len(backup.parts) == 1 and not backup_id:
+            send_backup_part(self.response, backup, 0)
+        else:
+            parts = [{"url": get_backup_part_url(backup, part["part"]),
+                      "done": part["part"] in backup.parts_done} for part in backup.parts]
             context = {"album": album,
-                       "photo_keyname_list": photo_keyname_list,
+                       "backup": backup,
+                       "parts": parts,
+                       "manifest_url": get_backup_manifest_url(backup),
             }
             self.response.out.write(render_with_user_and_settings('download_album.html', context))
 
 class AdminDownloadPhotos(ccRequestHandler):
     @requires_site_admin
     def get(self):
-        photo_keyname = self.request.get("photos", "").split(",")
-        name = self.request.get("name", "photos")
-
-        photos = model.DBPhoto.get_by_key_name(photo_keyname)
-        totalsize = sum([photo.size for photo in photos])
-        if totalsize <= 0:
-            raise Exception(_("photo not exist"))
-        if totalsize < GAE_RESPONSE_LIMIT:
-            self.response.headers["Content-Type"] = "application/zip"
-            self.response.headers["Content-Disposition"]= "attachment;filename=%s.zip"%name.encode("utf-8")
-            self.response.out.write(create_zipfile_from_photos(photos))
-
-            model.DBAlbum.set_last_backup_time(photos[0].album_name, datetime.now())
-        else:
-            raise Exception("Response too large: %s, max is %s"%(totalsize,GAE_RESPONSE_LIMIT))
+        backup = model.DBBackup.get_backup(force_unicode(self.request.get("album")), self.request.get("backup"))
+        part = long(self.request.get("part", 0))
+        if not backup or not 0 <= part < len(backup.parts):
+            raise Exception(_("backup not exist"))
+        send_backup_part(self.response, backup, part)
 
     post = get
 
+WATERMARK_SETTINGS = ["enable_watermark", "watermark_img", "watermark_position",
+                      "watermark_opacity", "watermark_quality"]
+
 class AdminSettingsPage(ccRequestHandler):
     @requires_site_owner
     def get(self):
@@ -744,6 +1099,7 @@ class AdminSettingsPage(ccRequestHandler):
             settings["enable_watermark"] = bool(settings.get("enable_watermark"))
             settings["block_referrers"] = bool(settings.get("block_referrers"))
 
+            old_watermark = [getattr(model.SITE_SETTINGS, name) for name in WATERMARK_SETTINGS]
             if settings["enable_watermark"]:
                 watermark = settings.get("watermark", "").strip()
                 settings["enable_watermark"] = False
@@ -756,20 +1112,124 @@ class AdminSettingsPage(ccRequestHandler):
                         settings["watermark_opacity"] = 1.0
                     elif opacity < 0.0:
                         settings["watermark_opacity"] = 0.0
+                    quality = long(settings.get("watermark_quality", 85))
+                    settings["watermark_quality"] = min(max(quality, 1), 100)
                     watermark_img = utils.get_watermark_img_from_google_chart(watermark, font_size)
                     if watermark_img:
                         settings["watermark_img"] = watermark_img
                         settings["enable_watermark"] = True
-                        memcache.flush_all()
                     else:
                         logging.exception("error in create watermark")
 
             model.SITE_SETTINGS.save_settings(**settings)
+            new_watermark = [getattr(model.SITE_SETTINGS, name) for name in WATERMARK_SETTINGS]
+            if model.SITE_SETTINGS.enable_watermark and new_watermark != old_watermark:
+                model.SITE_SETTINGS.save_settings(watermark_version=model.SITE_SETTINGS.watermark_version + 1)
+                model.invalidate_cache("watermark_cache")
+                model.DBPhoto.start_render_watermarks()
         elif default:
             model.DBSiteSettings.reset()
         self.redirect("/admin/settings/")
 
 
+#task handlers
+class TaskMigratePhotoOrder(webapp2.RequestHandler):
+    def post(self):
+        album = model.DBAlbum.get_album_by_name(self.request.get("album_name"))
+        if not album or not album.photoslist:
+            return
+        cursor = album.migrate_photo_order(self.request.get("cursor") or None)
+        if cursor:
+            taskqueue.add(url=self.request.path, params={"album_name": album.name, "cursor": cursor})
+
+
+class TaskMigrateEntityGroups(webapp2.RequestHandler):
+    def post(self):
+        kind = self.request.get("kind")
+        if model.migrate_entity_groups(kind):
+            taskqueue.add(url=self.request.path, params={"kind": kind})
+        elif kind != model.MIGRATION_KINDS[-1]:
+            next_kind = model.MIGRATION_KINDS[model.MIGRATION_KINDS.index(kind) + 1]
+            taskqueue.add(url=self.request.path, params={"kind": next_kind})
+        else:
+            model.finish_entity_group_migration()
+
+
+class TaskPhotoDerivatives(webapp2.RequestHandler):
+    MAX_RETRIES = 5
+
+    def post(self):
+        album_name, photo_name = model.DBPhoto.get_names_from_key_name(self.request.get("key_name"))
+        photo = model.DBPhoto.get_photo_by_name(album_name, photo_name)
+        if not photo:
+            return
+        try:
+            photo.generate_derivatives()
+        except Exception:
+            retries = long(self.request.headers.get("X-AppEngine-TaskRetryCount", 0))
+            if retries < self.MAX_RETRIES:
+                raise
+            logging.exception("generate derivatives of %s failed", photo.keyname)
+            photo.set_derivatives_failed()
+            return
+        ccPhotoRequestHandler.delete_photos_cache(album_name, [photo_name])
+        if model.SITE_SETTINGS.enable_watermark and not photo.watermark_ready:
+            try:
+                photo.render_watermark()
+            except Exception:
+                logging.exception("render watermark of %s failed", photo.keyname)
+
+
+class TaskRenderWatermarks(webapp2.RequestHandler):
+    def post(self):
+        cursor = model.DBPhoto.render_watermarks(long(self.request.get("version")),
+                                                 self.request.get("cursor") or None)
+        if cursor:
+            taskqueue.add(url=self.request.path, params={"version": self.request.get("version"),
+                                                         "cursor": cursor})
+
+
+class TaskBackfillDerivatives(webapp2.RequestHandler):
+    def post(self):
+        cursor = model.DBPhoto.backfill_derivatives(self.request.get("cursor") or None)
+        if cursor:
+            taskqueue.add(url=self.request.path, params={"cursor": cursor})
+        else:
+            model.finish_derivative_backfill()
+
+
+class TaskDeleteAlbum(webapp2.RequestHandler):
+    def post(self):
+        album = model.DBAlbum.get_deleting_album(self.request.get("album_name"))
+        if not album or not album.deleted:
+            return
+        photo_names, cursor = album.delete_batch(self.request.get("cursor") or None)
+        if photo_names:
+            ccPhotoRequestHandler.delete_photos_cache(album.name, photo_names)
+        if cursor:
+            taskqueue.add(url=self.request.path, params={"album_name": album.name, "cursor": cursor})
+
+
+class TaskCollectBlobs(webapp2.RequestHandler):
+    def post(self):
+        collection = model.DBBlobCollection.get_collection(self.request.get("collection_id"))
+        if not collection or collection.state == "done":
+            return
+        cursor = collection.collect(self.request.get("cursor") or None)
+        if cursor is not None:
+            taskqueue.add(url=self.request.path, params={"collection_id": collection.collection_id,
+                                                         "cursor": cursor})
+
+
+class TaskCountComments(webapp2.RequestHandler):
+    def post(self):
+        cursor = model.count_comments(self.request.get("cursor") or None)
+        if cursor:
+            taskqueue.add(url=self.request.path, params={"cursor": cursor})
+        else:
+            model.finish_comment_count_migration()
+
+
 class LoginPage(ccRequestHandler):
     def get(self):
         self.redirect(users.create_login_url(self.request.environ.get("HTTP_REFERER", "/")))
@@ -796,54 +1256,80 @@ class FeedPage(ccRequestHandler):
     
 #photos pages
 class MainPage(ccRequestHandler):
+    @cache_anonymous_page
     def get(self):
         lang = self.request.get("lang")
         if lang:
             save_current_lang(lang)
             self.redirect(self.request.environ.get("HTTP_REFERER", "/"))
-        albums, albums_cursor = get_all_albums(pagesize=model.SITE_SETTINGS.albums_per_page)
-
-        latestphotos = model.DBPhoto.get_latest_photos(model.SITE_SETTINGS.latest_photos_count,
-                    is_admin=check_admin_auth())
-
+            return
+        timer = RequestTimer("MainPage")
+        settings = model.SITE_SETTINGS
+        is_admin = check_admin_auth()
+        # the queries run concurrently, each wait below only covers what is left of it
+        with timer.span("start"):
+            albums_rpc = model.DBAlbum.get_all_albums_async(is_admin, settings.albums_per_page)
+            latestphotos_rpc = model.DBPhoto.get_latest_photos_async(settings.latest_photos_count,
+                                                                      is_admin=is_admin)
+            if settings.enable_comment:
+                latestcomments_rpc = model.DBComment.get_latest_comments_async(settings.latest_comments_count,
+                                                                               public=not is_admin)
+        with timer.span("albums"):
+            albums, albums_cursor = albums_rpc()
+        with timer.span("photos"):
+            latestphotos = latestphotos_rpc()
         context = {"albums": albums,
-                   "albums_cursor": albums_cursor,
+                   "albums_cursor": albums_cursor or "",
                    "latestphotos": latestphotos,
-                   "is_last_page": len(albums) < model.SITE_SETTINGS.albums_per_page
+                   "is_last_page": albums_cursor is None
         }
-        if model.SITE_SETTINGS.enable_comment:
-            latestcomments = model.DBComment.get_latest_comments(model.SITE_SETTINGS.latest_comments_count,
-                public= not check_admin_auth())
-            context.update({
-                "latestcomments": latestcomments })
-        self.response.out.write(render_with_user_and_settings('index.html', context))
+        if settings.enable_comment:
+            with timer.span("comments"):
+                context.update({
+                    "latestcomments": latestcomments_rpc() })
+        with timer.span("counts"):
+            model.get_comment_counts([album.keyname for album in albums])
+        with timer.span("render"):
+            html = render_with_user_and_settings('index.html', context)
+        timer.finish(self.response, send_header=is_admin)
+        self.response.out.write(html)
 
 
 class AlbumPage(ccRequestHandler):
+    @cache_anonymous_page
     def get(self, albumname):
         albumname = force_unicode(albumname)
         album = model.DBAlbum.get_album_by_name(albumname)
         if not album or (not album.public and not check_admin_auth()):
             raise Exception(_("album not exist"))
         photo_per_page = model.SITE_SETTINGS.thumbs_per_page
+        photos, photos_cursor = album.get_photos(photo_per_page)
+        model.get_comment_counts([photo.keyname for photo in photos])
         context = {"album": album,
                    "last_page": (album.photocount - 1) / photo_per_page,
                    "photo_per_page": photo_per_page,
                    "cur_page": 0,
-                   "photos": model.DBPhoto.get_by_key_name(album.photoslist[:photo_per_page])
+                   "photos": photos,
+                   "photos_cursor": photos_cursor or "",
         }
         self.response.out.write(render_with_user_and_settings('album.html', context))
 
 
+SLIDER_PAGE_SIZE = 40
+
 class SliderPage(ccRequestHandler):
+    @cache_anonymous_page
     def get(self, albumname):
         albumname = force_unicode(albumname)
         album = model.DBAlbum.get_album_by_name(albumname)
         if not album or (not album.public and not check_admin_auth()):
             raise Exception(_("album not exist"))
+        photos, photos_cursor = album.get_photos(SLIDER_PAGE_SIZE)
         context = {"album": album,
                    "host_url": self.request.host_url,
-                   "photos": model.DBPhoto.get_by_key_name(album.photoslist)
+                   "photos": photos,
+                   "photos_cursor": photos_cursor or "",
+                   "slider_page_size": SLIDER_PAGE_SIZE,
         }
         self.response.out.write(render_with_user_and_settings('slider.html', context))
 
@@ -854,8 +1340,8 @@ class PhotoPage(ccPhotoRequestHandler):
 
 
 class ThumbPage(ccPhotoRequestHandler):
-    def get(self, albumname, photoname):
-        self.send_photo(force_unicode(albumname), force_unicode(photoname), "thumb")
+    def get(self, albumname, photoname, size="thumb"):
+        self.send_photo(force_unicode(albumname), force_unicode(photoname), size)
 
 RESERVED_ALBUM_NAME = [u'login', u'logout', u'admin', u'slider', u'feed']
 app = webapp2.WSGIApplication([
@@ -869,13 +1355,23 @@ app = webapp2.WSGIApplication([
     (r'/admin/settings/', AdminSettingsPage),
     (r'/admin/blobupload/.*', UploadHandler),
     (r'/admin/upload/', AdminUploadPage),
+    (model.TASK_MIGRATE_PHOTO_ORDER_URL, TaskMigratePhotoOrder),
+    (model.TASK_PHOTO_DERIVATIVES_URL, TaskPhotoDerivatives),
+    (model.TASK_MIGRATE_ENTITY_GROUPS_URL, TaskMigrateEntityGroups),
+    (model.TASK_RENDER_WATERMARKS_URL, TaskRenderWatermarks),
+    (model.TASK_BACKFILL_DERIVATIVES_URL, TaskBackfillDerivatives),
+    (model.TASK_DELETE_ALBUM_URL, TaskDeleteAlbum),
+    (model.TASK_COLLECT_BLOBS_URL, TaskCollectBlobs),
+    (model.TASK_COUNT_COMMENTS_URL, TaskCountComments),
     (r'/slider/([^/]*?)/{0,1}', SliderPage),
     (r'/([^/]*?)/{0,1}', AlbumPage),
-    (r'/([^/]*?)/([^/]*?)/thumb/{0,1}', ThumbPage),
+    (r'/([^/]*?)/([^/]*?)/(thumb|thumb2x|medium)/{0,1}', ThumbPage),
     (r'/([^/]*?)/([^/]*?)', PhotoPage),
 ], debug=ENABLE_DEBUG)
 
 app = CCCookiesWSGIMiddleware(app)
+app = CCCacheSyncWSGIMiddleware(app, model.sync_cache_generations)
+app = CCContextWSGIMiddleware(app)
 
 def main():
     logging.info("call main()")
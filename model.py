@@ -1,49 +1,180 @@
 # -*- coding: utf-8 -*-
+import json
+import time
+import random
 import logging
+import threading
+from datetime import datetime, timedelta
+from collections import namedtuple
 from google.appengine.ext import db
+from google.appengine.ext import blobstore
 from google.appengine.api import images
 from google.appengine.api import datastore
-from google.appengine.api import blobstore
-from google.appengine.runtime import DeadlineExceededError
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.datastore import entity_pb
 
 import utils
+from lib import cc_context
+from lib.cc_cache import LRUCache, GenerationCounters, CacheNamespaces
+
+DB_CACHE_MAX_ENTRIES = 2000
+DB_CACHE_MAX_BYTES = 16*1024*1024
+DB_CACHE_TTL = 600 # seconds
+DB_MEMCACHE_PREFIX = "dbentity_"
+DB_MEMCACHE_TIME = 3600 * 24
+DB_MEMCACHE_LOCK_TIME = 5 # seconds, blocks write back of stale entities after a write
+
+def _entity_size(entity):
+    return db.model_to_protobuf(entity).ByteSize()
+
+def _entity_to_binary(entity):
+    return db.model_to_protobuf(entity).Encode()
+
+def _entity_from_binary(binary):
+    return db.model_from_protobuf(entity_pb.EntityProto(binary))
 
 # DataStore Cache in Memory
-_db_get_cache = {}
+_db_get_cache = LRUCache(max_entries=DB_CACHE_MAX_ENTRIES, max_bytes=DB_CACHE_MAX_BYTES,
+                         ttl=DB_CACHE_TTL, sizeof=_entity_size)
 logging.info("init db cache")
 
+# Per kind and per cache family generations, bumped on every write and checked once per request
+_db_generations = GenerationCounters(key_prefix="dbgeneration_")
+CACHED_KINDS = ["DBSiteSettings", "DBAlbum", "DBPhoto", "DBComment", "DBBackup", "DBBlobCollection"]
+
+# Memcache key families versioned with cache_key(), entries of an old generation age out
+CACHE_FAMILIES = ["photo_cache", "watermark_cache", "comment"]
+CACHE_FAMILY_TIME = 3600 * 24
+_cache_namespaces = CacheNamespaces(_db_generations, CACHE_FAMILIES)
+
+# local removals per kind, a read which started before one must not fill the local cache
+_db_removals = {}
+_db_removals_lock = threading.Lock()
+
+def _local_cache_set(versions, key, entity, size):
+    with _db_removals_lock:
+        if _db_removals.get(key.kind(), 0) == versions[key.kind()]:
+            _db_get_cache.set(key, entity, size)
+
 def get(keys, **kwargs):
     keys, multiple = datastore.NormalizeAndTypeCheckKeys(keys)
-    ret = db.get([key for key in keys if key not in _db_get_cache], **kwargs)
-    if (len(ret) == 1) and (ret[0] == None) and (not multiple):
-        return
-    _db_get_cache.update(dict([(x.key(), x) for x in ret if x is not None]))
-    ret = [_db_get_cache.get(k, None) for k in keys]
+    if db.is_in_transaction():
+        # transactional reads must see the datastore
+        ret = db.get(keys, **kwargs)
+    else:
+        entities = _db_get_cache.get_multi(keys)
+        missing = [key for key in keys if key not in entities]
+        with _db_removals_lock:
+            versions = dict((key.kind(), _db_removals.get(key.kind(), 0)) for key in missing)
+        if missing:
+            cached = memcache.get_multi([str(key) for key in missing], key_prefix=DB_MEMCACHE_PREFIX)
+            for key in missing:
+                binary = cached.get(str(key))
+                if binary:
+                    entity = _entity_from_binary(binary)
+                    _local_cache_set(versions, key, entity, len(binary))
+                    entities[key] = entity
+            missing = [key for key in missing if key not in entities]
+        if missing:
+            write_back = {}
+            for entity in db.get(missing, **kwargs):
+                if entity is not None:
+                    binary = _entity_to_binary(entity)
+                    _local_cache_set(versions, entity.key(), entity, len(binary))
+                    entities[entity.key()] = entity
+                    write_back[str(entity.key())] = binary
+            if write_back:
+                try:
+                    memcache.add_multi(write_back, time=DB_MEMCACHE_TIME, key_prefix=DB_MEMCACHE_PREFIX)
+                except:
+                    logging.exception("write back entities to memcache")
+        ret = [entities.get(k, None) for k in keys]
     if multiple:
         return ret
     if len(ret) > 0:
         return ret[0]
 
 
-def remove(keys):
+# keys written in the running run_in_xg_transaction, invalidated once it is over
+_transaction_local = threading.local()
+
+def remove(keys, content=True):
+    """Drops written entities from the caches. Bookkeeping writes which change nothing
+    rendered into pages pass content=False and leave the cached pages alone."""
     keys, _ = datastore.NormalizeAndTypeCheckKeys(keys)
-    return [_db_get_cache.pop(k) for k in keys if k in _db_get_cache]
+    pending = getattr(_transaction_local, "removed", None)
+    if pending is not None and db.is_in_transaction():
+        # readers before the commit would cache the old entities again
+        pending.update([(key, content) for key in keys])
+        return
+    kinds = set([key.kind() for key in keys])
+    # memcache first, other instances reload from it once they see the new generation
+    memcache.delete_multi([str(key) for key in keys], seconds=DB_MEMCACHE_LOCK_TIME,
+                          key_prefix=DB_MEMCACHE_PREFIX)
+    with _db_removals_lock:
+        for kind in kinds:
+            _db_removals[kind] = _db_removals.get(kind, 0) + 1
+        ret = _db_get_cache.delete_multi(keys)
+    _db_generations.bump(*kinds)
+    if content:
+        bump_content_generation(*kinds)
+    return ret
+
+
+def get_cache_stats():
+    return _db_get_cache.stats()
+
+
+def cache_key(family, *parts):
+    return _cache_namespaces.key(family, *parts)
+
+
+def invalidate_cache(*families):
+    """Invalidates whole key families on every instance, without flushing memcache."""
+    _cache_namespaces.invalidate(*families)
+
+
+# kinds rendered into pages, every content write to one of them changes the content generation
+PAGE_CONTENT_KINDS = ["DBSiteSettings", "DBAlbum", "DBPhoto", "DBComment", "DBCommentCounterShard"]
+PAGE_CONTENT_PREFIX = "content_"
+
+def bump_content_generation(*kinds):
+    _db_generations.bump(*[PAGE_CONTENT_PREFIX + kind for kind in kinds if kind in PAGE_CONTENT_KINDS])
+
+def content_generation():
+    return ".".join(["%d" % _db_generations.get(PAGE_CONTENT_PREFIX + kind) for kind in PAGE_CONTENT_KINDS])
+
+SYNCED_GENERATIONS = CACHED_KINDS + CACHE_FAMILIES + [PAGE_CONTENT_PREFIX + kind for kind in PAGE_CONTENT_KINDS]
 
 
 def call_method_with_list(method, keylist, page=8):
-    import math
-    pages = long(math.ceil(len(keylist)/float(page)))
-    for i in xrange(pages):
-        method(keylist[(i-1)*page:i*page])
+    for i in xrange(0, len(keylist), page):
+        method(keylist[i:i + page])
+
+def run_in_xg_transaction(function, *args, **kwargs):
+    """Runs function in a cross group transaction, the entities it removes from the
+    caches are removed after the commit."""
+    options = db.create_transaction_options(xg=True)
+    _transaction_local.removed = removed = set()
+    try:
+        return db.run_in_transaction_options(options, function, *args, **kwargs)
+    finally:
+        _transaction_local.removed = None
+        for content in (True, False):
+            keys = [key for key, key_content in removed if key_content == content]
+            if keys:
+                remove(keys, content=content)
 
 class DBParent(db.Model):
     pass
 
-BASEMODEL_PARENT = DBParent.get_or_insert("DBParent_basemodel_parent")
+# root of the single entity group every entity used to live in, see migrate_entity_groups()
+LEGACY_PARENT = db.Key.from_path(DBParent.kind(), "DBParent_basemodel_parent")
+ENTITY_GROUPS_MIGRATED = False
 
 class BaseModel(db.Model):
     key_template = ""
-    db_parent = BASEMODEL_PARENT
 
     @property
     def str_key(self):
@@ -83,7 +214,7 @@ class BaseModel(db.Model):
         self.save()
         return self
 
-    def put(self):
+    def put(self, content=True):
         count = 0
         while count < 3:
             try:
@@ -94,15 +225,16 @@ class BaseModel(db.Model):
                 count += 1
         else:
             raise db.Timeout()
-        remove(self.key())
+        remove(self.key(), content=content)
         return ret
 
     save = put
     Save = put
 
     def delete(self):
+        ret = super(BaseModel, self).delete()
         remove(self.key())
-        return super(BaseModel, self).delete()
+        return ret
 
     @classmethod
     def gen_key_name(cls, **kw):
@@ -112,27 +244,38 @@ class BaseModel(db.Model):
             logging.warn('generate key_name failed: %s <- %s',
                 cls.key_template, kw)
 
+    @classmethod
+    def parent_key(cls, key_name=None, values=None):
+        """Parent of an entity, the root of its entity group. Entities are their own group by default."""
+        return None
+
     @classmethod
     def get_by_key_name(cls, key_names, parent=None, **kwargs):
         try:
-            if not parent:
-                parent = cls.db_parent
-            parent = db._coerce_to_key(parent)
+            if parent:
+                parent = db._coerce_to_key(parent)
         except db.BadKeyError, e:
             raise db.BadArgumentError(str(e))
         rpc = datastore.GetRpcFromKwargs(kwargs)
         key_names, multiple = datastore.NormalizeAndTypeCheck(key_names, basestring)
-        keys = [datastore.Key.from_path(cls.kind(), name, parent=parent)
+        keys = [datastore.Key.from_path(cls.kind(), name, parent=parent or cls.parent_key(name))
                 for name in key_names]
+        entities = get(keys, rpc=rpc)
+        if not parent and not ENTITY_GROUPS_MIGRATED:
+            # not moved to its entity group yet
+            missing = [i for i, entity in enumerate(entities) if entity is None]
+            if missing:
+                legacy_keys = [datastore.Key.from_path(cls.kind(), key_names[i], parent=LEGACY_PARENT)
+                               for i in missing]
+                for i, entity in zip(missing, get(legacy_keys)):
+                    entities[i] = entity
         if multiple:
-            return get(keys, rpc=rpc)
+            return entities
         else:
-            return get(keys[0], rpc=rpc)
+            return entities[0]
 
     @classmethod
     def get_by_id(cls, ids, parent=None, **kwargs):
-        if not parent:
-            parent = cls.db_parent
         rpc = datastore.GetRpcFromKwargs(kwargs)
         if isinstance(parent, db.Model):
             parent = parent.key()
@@ -144,6 +287,57 @@ class BaseModel(db.Model):
         else:
             return get(keys[0], rpc=rpc)
 
+class AlbumIndexEntry(namedtuple("AlbumIndexEntry", "name public coverphoto")):
+    """Only what changes with the album settings, counts and the latest photo are read from
+    DBAlbum, so adding photos never writes the settings entity."""
+    __slots__ = ()
+
+    @classmethod
+    def from_album(cls, album):
+        return cls(album.name, album.public, album.coverphoto)
+
+    @property
+    def cover_url(self):
+        if self.coverphoto:
+            return DBPhoto.get_thumb_url_from_keyname(self.coverphoto)
+        return "/static/images/cover.jpg"
+
+
+class AlbumIndex(object):
+    "Immutable list of all albums, newest first, precomputed per visibility"
+    def __init__(self, entries=()):
+        self.albums = tuple(entries)
+        self.public_albums = tuple([entry for entry in self.albums if entry.public])
+        self._by_name = dict([(entry.name, entry) for entry in self.albums])
+
+    def __len__(self):
+        return len(self.albums)
+
+    def get(self, name):
+        return self._by_name.get(name)
+
+    def for_user(self, is_admin=False):
+        if is_admin:
+            return self.albums
+        return self.public_albums
+
+    def replace(self, entry):
+        if entry.name not in self._by_name:
+            return AlbumIndex((entry,) + self.albums)
+        return AlbumIndex([entry if e.name == entry.name else e for e in self.albums])
+
+    def remove(self, name):
+        return AlbumIndex([e for e in self.albums if e.name != name])
+
+    def to_json(self):
+        return json.dumps([list(entry) for entry in self.albums])
+
+    @classmethod
+    def from_json(cls, text):
+        # entries saved before the photo count was dropped are [name, public, photocount, coverphoto]
+        return cls([AlbumIndexEntry(entry[0], entry[1], entry[-1]) for entry in json.loads(text)])
+
+
 # DataStore Models
 class DBSiteSettings(BaseModel):
     key_template = "dbsitesettings/%(owner)s"
@@ -163,43 +357,213 @@ class DBSiteSettings(BaseModel):
     watermark_position = db.IntegerProperty(default=8)  # images.BOTTOM_RIGHT
     watermark_opacity = db.FloatProperty(default=0.4)
     watermark_img = db.BlobProperty()
+    watermark_quality = db.IntegerProperty(default=85)
+    watermark_version = db.IntegerProperty(default=0) # bumped whenever the watermark changes
     block_referrers = db.BooleanProperty(default=False)
     unblock_sites_list = db.ListProperty(str, default=[])
     adminlist = db.ListProperty(str, default=[])
-    albumlist = db.ListProperty(str, default=[])
+    albumlist = db.ListProperty(str, default=[]) # deprecated, replaced by albumindex
+    albumindex = db.TextProperty(default="")
+    entity_groups_migrated = db.BooleanProperty(default=False)
+    comments_counted = db.BooleanProperty(default=False) # comment counters filled by count_comments
+    derivatives_backfilled = db.BooleanProperty(default=False) # older photos queued by backfill_derivatives
+
+    @property
+    def album_index(self):
+        index = getattr(self, "_album_index", None)
+        if index is None:
+            if self.albumindex:
+                index = AlbumIndex.from_json(self.albumindex)
+            else:
+                # a transaction writes this entity itself, saving it on the side would conflict
+                index = self._rebuild_album_index(save=not db.is_in_transaction())
+            self._album_index = index
+        return index
+
+    @db.non_transactional
+    def _rebuild_album_index(self, save=True):
+        albums = DBAlbum.all().order("-createdate")
+        index = AlbumIndex([AlbumIndexEntry.from_album(album) for album in albums if not album.deleted])
+        if save and len(index):
+            self.albumindex = index.to_json()
+            self.albumlist = []
+            self.save(content=False)
+        return index
+
+    def _update_album_index(self, update):
+        def txn():
+            settings = DBSiteSettings.get_by_key_name(self.keyname)
+            index = update(settings.album_index)
+            if index is not settings.album_index:
+                settings._album_index = index
+                settings.albumindex = index.to_json()
+                settings.save()
+            return settings
+
+        if db.is_in_transaction():
+            settings = txn()
+        else:
+            settings = run_in_xg_transaction(txn)
+        self._album_index = settings.album_index
+        self.albumindex = settings.albumindex
+
+    def put(self, content=True):
+        self._admin_set = None
+        return super(DBSiteSettings, self).put(content=content)
+
+    save = put
+    Save = put
+
+    @property
+    def admin_set(self):
+        admins = getattr(self, "_admin_set", None)
+        if admins is None:
+            admins = self._admin_set = frozenset(self.adminlist)
+        return admins
 
     @property
     def AlbumList(self):
-        if not self.albumlist:
-            albums = DBAlbum.all()
-            need_save = False
-            for al in albums:
-                need_save = True
-                self.albumlist.insert(0, ",".join([al.name, str(al.public)]))
-            if need_save:
-                self.save()
-        albums = []
-        for album in self.albumlist:
-            album = album.split(",")
-            albums.append({"name": album[0],
-                           "public": album[1] == "True"})
-        return albums
+        return self.album_index.albums
 
     def add_album(self, album):
-        self.albumlist.insert(0, ",".join([album.name, str(album.public)]))
-        self.save()
+        self.update_album(album)
+
+    def update_album(self, album):
+        entry = AlbumIndexEntry.from_album(album)
+        if self.album_index.get(album.name) == entry:
+            return
+        self._update_album_index(lambda index: index.replace(entry))
 
     def remove_album(self, album):
-        self.albumlist.remove(",".join([album.name, str(album.public)]))
-        self.save()
+        def update(index):
+            if index.get(album.name):
+                return index.remove(album.name)
+            return index
+        self._update_album_index(update)
 
     @classmethod
     def reset(cls):
-        global SITE_SETTINGS
+        migrated = SITE_SETTINGS.entity_groups_migrated
+        counted = SITE_SETTINGS.comments_counted
+        backfilled = SITE_SETTINGS.derivatives_backfilled
+        # a version used before must not come back, stale watermarks would pass as current
+        watermark_version = SITE_SETTINGS.watermark_version + 1
         SITE_SETTINGS.delete()
-        SITE_SETTINGS = cls.get_or_insert("DBSiteSettings_site_settings", parent=cls.db_parent)
-
-SITE_SETTINGS = DBSiteSettings.get_or_insert("DBSiteSettings_site_settings", parent=BASEMODEL_PARENT)
+        load_site_settings()
+        SITE_SETTINGS.save_settings(entity_groups_migrated=migrated, comments_counted=counted,
+                                    derivatives_backfilled=backfilled, watermark_version=watermark_version)
+
+TASK_MIGRATE_ENTITY_GROUPS_URL = "/admin/tasks/migrate_entity_groups/"
+MIGRATION_KINDS = ["DBSiteSettings", "DBAlbum", "DBBackup", "DBPhoto", "DBComment"]
+
+def _copy_to_parent(entity, parent):
+    copy = datastore.Entity(entity.kind(), parent=parent, name=entity.key().name(),
+                            unindexed_properties=entity.unindexed_properties())
+    copy.update(entity)
+    return copy
+
+def migrate_entity_groups(kind, batch=100):
+    """Moves a batch of kind out of LEGACY_PARENT into the entity groups given by parent_key(),
+    the entities are copied with the low level api so auto_now properties are kept.
+    Resumable as every moved entity is deleted, returns False once nothing is left."""
+    cls = db.class_for_kind(kind)
+    legacy_keys = db.Query(cls, keys_only=True).ancestor(LEGACY_PARENT).fetch(batch)
+    if not legacy_keys:
+        return False
+
+    groups = {}
+    for entity in datastore.Get(legacy_keys):
+        if entity is not None:
+            parent = cls.parent_key(entity.key().name(), entity)
+            groups.setdefault(parent or entity.key(), (parent, []))[1].append(entity.key())
+
+    for parent, keys in groups.values():
+        def txn():
+            entities = [entity for entity in datastore.Get(keys) if entity is not None]
+            if entities:
+                datastore.Put([_copy_to_parent(entity, parent) for entity in entities])
+                datastore.Delete([entity.key() for entity in entities])
+        run_in_xg_transaction(txn)
+        remove(keys)
+    return True
+
+def start_entity_group_migration():
+    if memcache.add("migrate_entity_groups", 1, time=3600):
+        taskqueue.add(url=TASK_MIGRATE_ENTITY_GROUPS_URL, params={"kind": MIGRATION_KINDS[0]})
+
+def finish_entity_group_migration():
+    SITE_SETTINGS.save_settings(entity_groups_migrated=True)
+    load_site_settings()
+
+SITE_SETTINGS_KEY_NAME = "DBSiteSettings_site_settings"
+
+def load_site_settings():
+    global SITE_SETTINGS, ENTITY_GROUPS_MIGRATED
+    key = db.Key.from_path(DBSiteSettings.kind(), SITE_SETTINGS_KEY_NAME)
+    settings = get(key)
+    if not settings:
+        if migrate_entity_groups(DBSiteSettings.kind()):
+            settings = get(key)
+        else:
+            # nothing to migrate in a new site
+            settings = DBSiteSettings.get_or_insert(SITE_SETTINGS_KEY_NAME, entity_groups_migrated=True,
+                                                    comments_counted=True, derivatives_backfilled=True)
+    SITE_SETTINGS = settings
+    ENTITY_GROUPS_MIGRATED = settings.entity_groups_migrated
+    if not ENTITY_GROUPS_MIGRATED:
+        start_entity_group_migration()
+    elif not settings.comments_counted:
+        start_comment_count_migration()
+    elif not settings.derivatives_backfilled:
+        start_derivative_backfill()
+    return SITE_SETTINGS
+
+def sync_cache_generations():
+    """Drops local entities of the kinds written by other instances, costs one memcache get_multi."""
+    changed = _db_generations.sync(SYNCED_GENERATIONS)
+    if changed:
+        with _db_removals_lock:
+            for kind in changed:
+                _db_removals[kind] = _db_removals.get(kind, 0) + 1
+            _db_get_cache.delete_if(lambda key: key.kind() in changed)
+        if DBSiteSettings.kind() in changed:
+            load_site_settings()
+    return changed
+
+_db_generations.sync(SYNCED_GENERATIONS)
+SITE_SETTINGS = load_site_settings()
+
+PHOTO_INDEX_CURSOR = "index:"
+TASK_MIGRATE_PHOTO_ORDER_URL = "/admin/tasks/migrate_photo_order/"
+TASK_PHOTO_DERIVATIVES_URL = "/admin/tasks/photo_derivatives/"
+TASK_RENDER_WATERMARKS_URL = "/admin/tasks/render_watermarks/"
+TASK_BACKFILL_DERIVATIVES_URL = "/admin/tasks/backfill_derivatives/"
+TASK_DELETE_ALBUM_URL = "/admin/tasks/delete_album/"
+DELETE_ALBUM_BATCH = 30 # also the limit of values of an IN filter
+TASK_COLLECT_BLOBS_URL = "/admin/tasks/collect_blobs/"
+BLOB_COLLECTION_GRACE = 24 * 3600 # seconds, a younger blob may belong to an upload in progress
+BLOB_COLLECTION_BATCH = 100
+BLOB_COLLECTION_REPORT_SIZE = 100 # orphans listed in the report of a run
+TASK_COUNT_COMMENTS_URL = "/admin/tasks/count_comments/"
+BACKUP_KEEP_DAYS = 30 # a backup created longer ago is deleted with the next backup of its album
+COMMENT_COUNTER_SHARDS = 5
+COMMENT_COUNT_PREFIX = "comment_count_"
+COMMENT_COUNT_TIME = 3600
+COMMENT_COUNT_LOCK_TIME = 5 # seconds
+
+# derivatives generated for every photo: (name, max width, max height)
+DERIVATIVE_SIZES = [
+    ("thumb", 280, 210),
+    ("thumb2x", 560, 420),
+    ("medium", 1024, 768),
+]
+DERIVATIVE_QUALITY = 85
+PHOTO_HEADER_SIZE = 64*1024 # bytes of an uploaded blob read for type and dimensions
+
+class DerivativeState:
+    PENDING = "pending"
+    READY = "ready"
+    FAILED = "failed"
 
 class DBAlbum(BaseModel):
     key_template = "dbalbum/%(albumname)s"
@@ -210,13 +574,26 @@ class DBAlbum(BaseModel):
     createdate = db.DateTimeProperty(auto_now_add=True)
     updatedate = db.DateTimeProperty(auto_now=True)
     lastbackupdate = db.DateTimeProperty()
-    photoslist = db.ListProperty(str)
+    photoslist = db.ListProperty(str) # legacy order, emptied by migrate_photo_order
     coverphoto = db.StringProperty(default="")
+    photo_count = db.IntegerProperty(default=0)
+    latest_photo = db.StringProperty(default="")
+    deleted = db.BooleanProperty(default=False)
+    deleted_photo_count = db.IntegerProperty(default=0)
+
+    def save_settings(self, **kwds):
+        ret = super(DBAlbum, self).save_settings(**kwds)
+        SITE_SETTINGS.update_album(self)
+        return ret
+
+    @classmethod
+    def key_for(cls, name):
+        return db.Key.from_path(cls.kind(), cls.gen_key_name(albumname=name))
 
     @classmethod
     def check_exist(cls, name):
         key_name = cls.gen_key_name(albumname=name)
-        return cls.get_by_key_name(key_name, parent=cls.db_parent)
+        return cls.get_by_key_name(key_name)
 
     @classmethod
     def create(cls, name, description="", public=True, **kwds):
@@ -224,28 +601,54 @@ class DBAlbum(BaseModel):
 
         def txn():
             dbalbum = cls(key_name=key_name, name=name, description=description,
-                public=public, parent=cls.db_parent, **kwds)
+                public=public, **kwds)
             dbalbum.save()
             SITE_SETTINGS.add_album(dbalbum)
             return dbalbum
 
-        return db.run_in_transaction(txn)
+        return run_in_xg_transaction(txn)
 
     @classmethod
     def get_all_albums(cls, is_admin=False, pagesize=20, start_cursor=None, order="-createdate"):
+        return cls.get_all_albums_async(is_admin, pagesize, start_cursor, order)()
+
+    @classmethod
+    def get_all_albums_async(cls, is_admin=False, pagesize=20, start_cursor=None, order="-createdate"):
+        """Sends the query of get_all_albums, returns a function which waits for its result.
+        Albums being deleted are skipped and made up for, the cursor is None on the last page."""
         if is_admin == True:
             query = cls.all().order(order)
         else:
             query = cls.all().filter("public =", True).order(order)
         query.with_cursor(start_cursor=start_cursor)
-        albums = query.fetch(pagesize)
-        end_cursor = query.cursor()
-        return albums, end_cursor
+        results = query.run(limit=pagesize, batch_size=pagesize)
+
+        def get_result():
+            albums = []
+            batch, limit = list(results), pagesize
+            while True:
+                albums += [album for album in batch if not album.deleted]
+                if len(batch) < limit:
+                    return albums, None
+                if len(albums) >= pagesize:
+                    return albums, query.cursor()
+                limit = pagesize - len(albums)
+                query.with_cursor(start_cursor=query.cursor())
+                batch = query.fetch(limit)
+        return get_result
 
     @classmethod
     def get_album_by_name(cls, name):
+        album = cls.get_deleting_album(name)
+        if album and not album.deleted:
+            return album
+        return None
+
+    @classmethod
+    def get_deleting_album(cls, name):
+        """Returns the album even if it is being deleted, use get_album_by_name for everything else."""
         key_name = cls.gen_key_name(albumname=name)
-        return cls.get_by_key_name(key_name, parent=cls.db_parent)
+        return cls.get_by_key_name(key_name)
 
     @classmethod
     def set_last_backup_time(cls, name, time):
@@ -254,95 +657,215 @@ class DBAlbum(BaseModel):
             album.lastbackupdate = time
             album.save()
 
+    @property
+    def comment_count(self):
+        return get_comment_count(self.keyname)
+
     @property
     def photocount(self):
-        return len(self.photoslist)
+        if self.photoslist:
+            return len(self.photoslist)
+        return self.photo_count
 
     @property
     def cover_url(self):
         if self.coverphoto:
             return DBPhoto.get_thumb_url_from_keyname(self.coverphoto)
+        if self.latest_photo:
+            return DBPhoto.get_thumb_url_from_keyname(self.latest_photo)
         if self.photoslist:
             return DBPhoto.get_thumb_url_from_keyname(self.photoslist[0])
         return "/static/images/cover.jpg"
 
+    def get_photos(self, pagesize=20, cursor=None):
+        """Returns a page of photos, newest first, and the cursor of the next page or None."""
+        offset = 0
+        if cursor and cursor.startswith(PHOTO_INDEX_CURSOR):
+            offset = long(cursor[len(PHOTO_INDEX_CURSOR):])
+            cursor = None
+        if self.photoslist:
+            self.start_photo_order_migration()
+            end = pagesize and offset + pagesize or None
+            photos = [p for p in DBPhoto.get_by_key_name(self.photoslist[offset:end]) if p]
+            if end and end < len(self.photoslist):
+                return photos, "%s%d" % (PHOTO_INDEX_CURSOR, end)
+            return photos, None
+
+        query = DBPhoto.all(keys_only=True).filter("album_name =", self.name).order("-sortkey")
+        query.with_cursor(start_cursor=cursor)
+        keys = query.fetch(pagesize, offset)
+        photos = [p for p in get(keys) if p]
+        if pagesize and len(keys) == pagesize:
+            return photos, query.cursor()
+        return photos, None
+
+    def start_photo_order_migration(self):
+        # the photos are counted with an ancestor query, they have to be children of the album
+        if not ENTITY_GROUPS_MIGRATED:
+            return
+        if memcache.add("migrate_photo_order_%s" % self.keyname, 1, time=3600):
+            taskqueue.add(url=TASK_MIGRATE_PHOTO_ORDER_URL, params={"album_name": self.name})
+
+    def migrate_photo_order(self, cursor=None, batch=100):
+        """Moves one batch of the legacy photoslist order onto DBPhoto.sortkey,
+        returns the cursor of the next batch or None when the album is migrated."""
+        count = len(self.photoslist)
+        order = dict([(key_name, count - index) for index, key_name in enumerate(self.photoslist)])
+        query = DBPhoto.all().ancestor(DBAlbum.key_for(self.name))
+        query.with_cursor(start_cursor=cursor)
+        photos = query.fetch(batch)
+        changed = []
+        for photo in photos:
+            if photo.sortkey is None:
+                photo.sortkey = order.get(photo.keyname, 0)
+                changed.append(photo)
+        if changed:
+            db.put(changed)
+            remove([photo.key() for photo in changed])
+        if len(photos) == batch:
+            return query.cursor()
+
+        def txn():
+            # counted in the transaction, an upload meanwhile makes it count again
+            album = DBAlbum.get_album_by_name(self.name)
+            if album.photoslist:
+                album.latest_photo = album.latest_photo or album.photoslist[0]
+                album.photoslist = []
+            album.photo_count = DBPhoto.all(keys_only=True).ancestor(album.key()).count(None)
+            album.save()
+            return album
+
+        photo_count = run_in_xg_transaction(txn).photo_count
+        logging.info("photo order of album %s migrated, %d photos", self.name, photo_count)
+        return None
+
     def add_photo_to_album(self, photo):
-        photo_key_name = photo.key().name()
+        return self.add_photos_to_album([photo])
+
+    def add_photos_to_album(self, photos):
+        """Adds photos with one transaction, the last one becomes the latest photo."""
+        photo_key_names = [photo.key().name() for photo in photos]
         def txn():
             album = DBAlbum.get_album_by_name(self.name)
-            if photo_key_name not in album.photoslist:
-                album.photoslist.insert(0, photo_key_name)
-                album.save()
+            if album.photoslist:
+                for photo_key_name in photo_key_names:
+                    if photo_key_name not in album.photoslist:
+                        album.photoslist.insert(0, photo_key_name)
+            album.photo_count += len(photo_key_names)
+            album.latest_photo = photo_key_names[-1]
+            album.save()
             return album
 
-        return db.run_in_transaction(txn)
+        return run_in_xg_transaction(txn)
 
     def remove(self):
-        photos = DBPhoto.get_by_key_name(self.photoslist)
-        photo_keys = []
-        blob_keys = []
-        thumb_blob_keys = []
-        comments_keys = []
-        for photo in photos:
-            photo_keys.append(photo.key())
-            blob_keys.append(photo.blob_key)
-            thumb_blob_keys.append(photo.thumb_blob_key)
-            comments_keys = comments_keys + [comment.key() for comment in
-                                             DBComment.get_comments(photo.album_name, photo.photo_name)]
-
+        """Hides the album at once, TASK_DELETE_ALBUM_URL deletes its photos, comments and blobs."""
         def txn():
-            remove(photo_keys)
-            remove(comments_keys)
-            db.delete(comments_keys)
-            SITE_SETTINGS.remove_album(self)
-            db.delete(photo_keys)
-            self.delete()
+            album = DBAlbum.get_deleting_album(self.name)
+            album.deleted = True
+            album.deleted_photo_count = 0
+            album.save()
+            SITE_SETTINGS.remove_album(album)
+            taskqueue.add(url=TASK_DELETE_ALBUM_URL, params={"album_name": self.name}, transactional=True)
+            return album
 
-        db.run_in_transaction(txn)
+        return run_in_xg_transaction(txn)
+
+    def _all_photos_query(self):
+        # ancestor queries see every photo put before them, none is left behind the album,
+        # while entity groups are migrated the photos may be under either parent
+        if ENTITY_GROUPS_MIGRATED:
+            return DBPhoto.all().ancestor(DBAlbum.key_for(self.name))
+        return DBPhoto.all().filter("album_name =", self.name)
+
+    def delete_batch(self, cursor=None, batch=DELETE_ALBUM_BATCH):
+        """Deletes one batch of photos with their comments and blobs, returns the names
+        of the deleted photos and the cursor of the next batch, or None when the album is gone."""
+        query = self._all_photos_query()
+        query.with_cursor(start_cursor=cursor)
+        photos = query.fetch(batch)
+        if not photos and cursor:
+            # photos put behind the cursor while deleting
+            query = self._all_photos_query()
+            photos = query.fetch(batch)
+        if not photos:
+            remove([self.key()])
+            self.delete()
+            delete_comment_counts([self.keyname])
+            backup_keys = DBBackup.all(keys_only=True).filter("album_name =", self.name).fetch(None)
+            db.delete(backup_keys)
+            remove(backup_keys)
+            logging.info("album %s deleted, %d photos", self.name, self.deleted_photo_count)
+            return [], None
+
+        photo_keys = [photo.key() for photo in photos]
+        comment_keys = DBComment.get_comment_keys([photo.keyname for photo in photos])
+        blob_keys = []
+        for photo in photos:
+            blob_keys += photo.all_blob_keys
+        # blobs go first, a failed batch is retried by the task queue before its photos are lost
         blobstore.delete(blob_keys)
-        blobstore.delete(thumb_blob_keys)
+        remove(photo_keys + comment_keys)
+        db.delete(photo_keys + comment_keys)
+        delete_comment_counts([photo.keyname for photo in photos])
+        self.deleted_photo_count += len(photos)
+        self.save()
+        return [photo.photo_name for photo in photos], query.cursor()
+
+    def to_delete_status(self):
+        return {"album_name": self.name,
+                "state": self.deleted and "deleting" or "active",
+                "deleted_photo_count": self.deleted_photo_count,
+                "photo_count": self.photocount}
 
     def delete_photos_by_name(self, photo_names):
         photo_key_name_list = []
         for photo_name in photo_names:
             photo_key_name_list.append(DBPhoto.gen_key_name(album_name=self.name, photo_name=photo_name))
-        photos = DBPhoto.get_by_key_name(photo_key_name_list)
+        photos = [photo for photo in DBPhoto.get_by_key_name(photo_key_name_list) if photo]
         photo_keys = []
         blob_keys = []
         thumb_blob_keys = []
-        comments_keys = []
         for photo in photos:
             photo_keys.append(photo.key())
             blob_keys.append(photo.blob_key)
-            thumb_blob_keys.append(photo.thumb_blob_key)
-            comments_keys = comments_keys + [comment.key() for comment in
-                                             DBComment.get_comments(photo.album_name, photo.photo_name)]
+            thumb_blob_keys += [key for key in photo.all_blob_keys if key != photo.blob_key]
+        comments_keys = DBComment.get_comment_keys([photo.keyname for photo in photos])
 
         def txn():
             remove(photo_keys)
             db.delete(photo_keys)
             remove(comments_keys)
             db.delete(comments_keys)
-            for photo_key_name in photo_key_name_list:
-                self.photoslist.remove(photo_key_name)
-                if photo_key_name == self.coverphoto:
-                    self.coverphoto = ""
-            self.save()
+            if comments_keys:
+                add_comment_counts({self.keyname: -len(comments_keys)})
+            album = DBAlbum.get_album_by_name(self.name)
+            for photo in photos:
+                if photo.keyname in album.photoslist:
+                    album.photoslist.remove(photo.keyname)
+                if photo.keyname == album.coverphoto:
+                    album.coverphoto = ""
+                if photo.keyname == album.latest_photo:
+                    album.latest_photo = ""
+            album.photo_count = max(album.photo_count - len(photo_keys), 0)
+            album.save()
             return len(photo_keys)
 
-        count = db.run_in_transaction(txn)
+        count = run_in_xg_transaction(txn)
+        if comments_keys:
+            offset_comment_counts({self.keyname: -len(comments_keys)})
+        delete_comment_counts([photo.keyname for photo in photos])
+        album = DBAlbum.get_album_by_name(self.name)
+        if not album.latest_photo and not album.photoslist:
+            newest, _ = album.get_photos(1)
+            if newest:
+                album.latest_photo = newest[0].keyname
+                album.save()
         try:
-            call_method_with_list(blobstore.delete, blob_keys, 8)
-        except DeadlineExceededError:
-            call_method_with_list(blobstore.delete, blob_keys, 2)
+            call_method_with_list(blobstore.delete, blob_keys + thumb_blob_keys, BLOB_COLLECTION_BATCH)
         except:
+            # left to DBBlobCollection
             logging.exception("delete blob")
-        try:
-            call_method_with_list(blobstore.delete, thumb_blob_keys, 8)
-        except DeadlineExceededError:
-            call_method_with_list(blobstore.delete, thumb_blob_keys, 2)
-        except:
-            logging.exception("delete thumb blob")
         return count
 
     def set_cover_photo(self, photo_name):
@@ -350,8 +873,7 @@ class DBAlbum(BaseModel):
         photo = DBPhoto.get_by_key_name(photo_key_name)
         if not photo:
             return False
-        self.coverphoto = photo_key_name
-        self.save()
+        self.save_settings(coverphoto=photo_key_name)
         return True
 
     def to_dict(self):
@@ -363,9 +885,9 @@ class DBAlbum(BaseModel):
             "createdate": self.createdate.isoformat(),
             "updatedate": self.updatedate.isoformat(),
             "lastbackupdate": self.lastbackupdate and self.lastbackupdate.isoformat() or "",
-            "photoslist": self.photoslist,
             "cover_url": self.cover_url,
             "photocount": self.photocount,
+            "comment_count": self.comment_count,
             }
 
 
@@ -385,6 +907,12 @@ class DBPhoto(BaseModel):
     blob_key = db.StringProperty()
     thumb_blob_key = db.StringProperty()
     site = db.StringProperty(default="")
+    sortkey = db.IntegerProperty() # position in the album, newest is highest
+    derivatives = db.StringListProperty() # "name:blob_key", the thumb lives in thumb_blob_key
+    derivative_state = db.StringProperty(default=DerivativeState.READY)
+    watermark_blob_key = db.StringProperty()
+    watermark_version = db.IntegerProperty(default=0) # SITE_SETTINGS.watermark_version of watermark_blob_key
+    blob_keys = db.ComputedProperty(lambda self: self.all_blob_keys) # queried by DBBlobCollection
 
     @property
     def url(self):
@@ -394,10 +922,176 @@ class DBPhoto(BaseModel):
     def thumb_url(self):
         return "/%s/%s/thumb/" % (self.album_name, self.photo_name)
 
+    @property
+    def medium_url(self):
+        return "/%s/%s/medium/" % (self.album_name, self.photo_name)
+
+    @property
+    def thumb2x_url(self):
+        return "/%s/%s/thumb2x/" % (self.album_name, self.photo_name)
+
     @property
     def is_public(self):
         return self.public
 
+    @property
+    def derivatives_ready(self):
+        return self.derivative_state == DerivativeState.READY
+
+    def get_derivative_key(self, name):
+        """Returns the blob key of a derivative, None if it does not exist (yet)."""
+        if name == "thumb":
+            return self.thumb_blob_key
+        for derivative in self.derivatives:
+            derivative_name, blob_key = derivative.split(":", 1)
+            if derivative_name == name:
+                return blob_key
+        return None
+
+    @property
+    def missing_derivatives(self):
+        """Names of the derivatives this photo should have but has not, all of them while
+        pending and the ones added to DERIVATIVE_SIZES after the photo was rendered."""
+        return [name for name, width, height in DERIVATIVE_SIZES
+                if (name == "thumb" or self.width > width or self.height > height)
+                and not self.get_derivative_key(name)]
+
+    @property
+    def derivative_blob_keys(self):
+        blob_keys = [self.thumb_blob_key] + [derivative.split(":", 1)[1] for derivative in self.derivatives]
+        return [blob_key for blob_key in blob_keys if blob_key]
+
+    @property
+    def all_blob_keys(self):
+        blob_keys = [self.blob_key, self.watermark_blob_key] + self.derivative_blob_keys
+        return [blob_key for blob_key in blob_keys if blob_key]
+
+    def start_derivatives(self):
+        taskqueue.add(url=TASK_PHOTO_DERIVATIVES_URL, params={"key_name": self.keyname})
+
+    @classmethod
+    def start_derivatives_multi(cls, photos):
+        tasks = [taskqueue.Task(url=TASK_PHOTO_DERIVATIVES_URL, params={"key_name": photo.keyname})
+                 for photo in photos]
+        queue = taskqueue.Queue()
+        for i in xrange(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+            queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+
+    def generate_derivatives(self):
+        """Renders all DERIVATIVE_SIZES from the original blob, sizes larger
+        than the original are left out and served from the original."""
+        created = {}
+        for name, width, height in DERIVATIVE_SIZES:
+            if name != "thumb" and self.width <= width and self.height <= height:
+                continue
+            img = images.Image(blob_key=self.blob_key)
+            img.resize(width, height)
+            binary = img.execute_transforms(output_encoding=images.JPEG, quality=DERIVATIVE_QUALITY)
+            created[name] = str(utils.create_blob_file(utils.ImageMime.JPEG, binary,
+                u"%s_%s_%s"%(name, self.album_name, self.photo_name)))
+
+        def txn():
+            photo = DBPhoto.get_by_key_name(self.keyname)
+            if not photo:
+                return []
+            old_blob_keys = photo.derivative_blob_keys
+            photo.thumb_blob_key = created.pop("thumb", None)
+            photo.derivatives = ["%s:%s" % (name, blob_key) for name, blob_key in created.items()]
+            photo.derivative_state = DerivativeState.READY
+            photo.save(content=False)
+            return old_blob_keys
+
+        old_blob_keys = run_in_xg_transaction(txn)
+        if old_blob_keys:
+            blobstore.delete(old_blob_keys)
+
+    @classmethod
+    def backfill_derivatives(cls, cursor=None, batch=100):
+        """Queues the rendering of the photos of a batch which miss derivatives, returns the
+        cursor of the next batch or None when all photos are checked."""
+        query = cls.all()
+        query.with_cursor(start_cursor=cursor)
+        photos = query.fetch(batch)
+        cls.start_derivatives_multi([photo for photo in photos
+                                     if photo.derivative_state == DerivativeState.READY and photo.missing_derivatives])
+        if len(photos) < batch:
+            return None
+        return query.cursor()
+
+    def set_derivatives_failed(self):
+        self.derivative_state = DerivativeState.FAILED
+        self.save(content=False)
+
+    @property
+    def watermark_ready(self):
+        return bool(self.watermark_blob_key) and self.watermark_version == SITE_SETTINGS.watermark_version
+
+    def render_watermark(self):
+        """Composites the site watermark onto the original and stores it as a blob,
+        PNG photos stay PNG, everything else is encoded as JPEG. Returns the blob key."""
+        settings = SITE_SETTINGS
+        version = settings.watermark_version
+        if self.mime == utils.ImageMime.PNG:
+            mime_type, options = utils.ImageMime.PNG, {"output_encoding": images.PNG}
+        else:
+            mime_type, options = utils.ImageMime.JPEG, {"output_encoding": images.JPEG,
+                                                        "quality": settings.watermark_quality}
+        binary = images.composite([(images.Image(blob_key=self.blob_key), 0, 0, 1.0, images.TOP_LEFT),
+            (settings.watermark_img, 0, 0, settings.watermark_opacity, settings.watermark_position),
+        ], self.width, self.height, 0, **options)
+        blob_key = str(utils.create_blob_file(mime_type, binary,
+            u"watermark_%s_%s"%(self.album_name, self.photo_name)))
+
+        def txn():
+            photo = DBPhoto.get_by_key_name(self.keyname)
+            if not photo:
+                return blob_key, [blob_key]
+            if photo.watermark_blob_key and photo.watermark_version == version:
+                # a concurrent request rendered it first, keep theirs
+                return photo.watermark_blob_key, [blob_key]
+            old_blob_key = photo.watermark_blob_key
+            photo.watermark_blob_key = blob_key
+            photo.watermark_version = version
+            photo.save(content=False)
+            return blob_key, old_blob_key and [old_blob_key] or []
+
+        blob_key, unused_blob_keys = run_in_xg_transaction(txn)
+        if unused_blob_keys:
+            blobstore.delete(unused_blob_keys)
+        self.watermark_blob_key = blob_key
+        self.watermark_version = version
+        return blob_key
+
+    @classmethod
+    def start_render_watermarks(cls):
+        taskqueue.add(url=TASK_RENDER_WATERMARKS_URL, params={"version": SITE_SETTINGS.watermark_version})
+
+    @classmethod
+    def render_watermarks(cls, version, cursor=None, batch=10):
+        """Renders the watermark of a batch of photos which are out of date, returns the
+        cursor of the next batch, or None when done or a newer watermark took over."""
+        query = cls.all()
+        if cursor:
+            query.with_cursor(cursor)
+        photos = query.fetch(batch)
+        for photo in photos:
+            if not SITE_SETTINGS.enable_watermark or SITE_SETTINGS.watermark_version != version:
+                return None
+            if photo.watermark_ready:
+                continue
+            try:
+                photo.render_watermark()
+            except Exception:
+                # rendered on demand when the photo is requested
+                logging.exception("render watermark of %s failed", photo.keyname)
+        if len(photos) < batch:
+            return None
+        return query.cursor()
+
+    @property
+    def comment_count(self):
+        return get_comment_count(self.keyname)
+
     @property
     def Comments(self):
         try:
@@ -406,26 +1100,46 @@ class DBPhoto(BaseModel):
             return DBComment.get_comments(self.album_name, self.photo_name)
 
     def remove(self):
-        blobstore.delete(self.blod_key)
-        blobstore.delete(self.thumb_blob_key)
+        blobstore.delete(self.all_blob_keys)
         DBComment.del_comments(self.album_name, self.photo_name)
-        self.remove()
+        self.delete()
+        delete_comment_counts([self.keyname])
+
+    @staticmethod
+    def new_sortkey():
+        return long(time.time() * 1000000)
 
     @classmethod
     def get_photo_by_name(cls, album_name, photo_name):
         key_name = cls.gen_key_name(album_name=album_name, photo_name=photo_name)
-        return cls.get_by_key_name(key_name, parent=cls.db_parent)
+        return cls.get_by_key_name(key_name)
+
+    @classmethod
+    def parent_key(cls, key_name=None, values=None):
+        # photos live in the entity group of their album
+        return DBAlbum.key_for(cls.get_names_from_key_name(key_name)[0])
 
     @classmethod
     def get_latest_photos(cls, count, is_admin=False):
-        if is_admin:
-            query = cls.all()
-        else:
-            query = cls.all().filter("public =", True)
-        try:
-            return query.order("-updatedate").fetch(count)
-        except:
-            return query.order("-createdate").fetch(count)
+        return cls.get_latest_photos_async(count, is_admin)()
+
+    @classmethod
+    def get_latest_photos_async(cls, count, is_admin=False):
+        """Sends the query of get_latest_photos, returns a function which waits for its result."""
+        def query(order):
+            if is_admin:
+                return cls.all().order(order)
+            return cls.all().filter("public =", True).order(order)
+        results = query("-updatedate").run(limit=count, batch_size=count)
+
+        def get_result():
+            try:
+                photos = list(results)
+            except:
+                photos = query("-createdate").fetch(count)
+            # photos of an album being deleted stay until TASK_DELETE_ALBUM_URL reaches them
+            return [photo for photo in photos if SITE_SETTINGS.album_index.get(photo.album_name)]
+        return get_result
 
     @classmethod
     def get_names_from_key_name(cls, key_name):
@@ -452,20 +1166,86 @@ class DBPhoto(BaseModel):
         if photo:
             raise Exception("file existed")
 
-        photo = cls(key_name=photo_key_name, album_name=album_name, parent=cls.db_parent, **kwds)
-        photo.photo_name = file_name
-        photo.size = len(binary)
         mime_type = utils.get_img_type(binary)
-        photo.mime = mime_type
-        img = images.Image(binary)
-        photo.width = img.width
-        photo.height = img.height
-        thumb = images.resize(binary, 280, 210, images.JPEG)
+        dimensions = utils.get_img_dimensions(binary)
+        if not dimensions:
+            img = images.Image(binary)
+            dimensions = img.width, img.height
         blob_key = utils.create_blob_file(mime_type, binary, u"%s_%s"%(album_name,file_name))
-        thumb_blob_key = utils.create_blob_file(utils.ImageMime.JPEG, thumb, u"thumb_%s_%s"%(album_name,file_name))
-        photo.blob_key = str(blob_key)
-        photo.thumb_blob_key = str(thumb_blob_key)
-        photo.save()
+        try:
+            photo = cls._new_photo(photo_key_name, album_name, file_name, str(blob_key),
+                                   len(binary), mime_type, dimensions, **kwds)
+            photo.save()
+        except:
+            blobstore.delete(blob_key)
+            raise
+        photo.start_derivatives()
+        return photo
+
+    @classmethod
+    def create_from_blobs(cls, album_name, uploads, **kwds):
+        """Creates photos of uploaded blobs, uploads is a list of (file_name, blob_info), only the
+        header of each blob is read. Existence is checked with one batch get and the photos are
+        written with one put, the album is left to the caller. Returns (photos, errors), errors
+        is a list of (file_name, message)."""
+        photos = []
+        errors = []
+        key_names = [cls.gen_key_name(album_name=album_name, photo_name=file_name) for file_name, _blob in uploads]
+        existing = key_names and cls.get_by_key_name(key_names) or []
+        headers = []
+        seen = set()
+        for (file_name, blob_info), photo_key_name, photo in zip(uploads, key_names, existing):
+            if photo or photo_key_name in seen:
+                errors.append((file_name, "photo already exists in this album"))
+                continue
+            seen.add(photo_key_name)
+            rpc = blobstore.fetch_data_async(blob_info.key(), 0, min(blob_info.size, PHOTO_HEADER_SIZE) - 1)
+            headers.append((photo_key_name, file_name, blob_info, rpc))
+
+        sortkey = cls.new_sortkey()
+        for photo_key_name, file_name, blob_info, rpc in headers:
+            try:
+                mime_type, dimensions = cls._read_blob_header(blob_info, rpc.get_result())
+            except Exception, e:
+                errors.append((file_name, unicode(e)))
+                continue
+            photo = cls._new_photo(photo_key_name, album_name, file_name, str(blob_info.key()),
+                                   blob_info.size, mime_type, dimensions, **kwds)
+            photo.sortkey = sortkey + len(photos)
+            photos.append(photo)
+
+        if photos:
+            db.put(photos)
+            remove([photo.key() for photo in photos])
+            cls.start_derivatives_multi(photos)
+        return photos, errors
+
+    @staticmethod
+    def _read_blob_header(blob_info, header):
+        blob_key = blob_info.key()
+        mime_type = utils.get_img_type(header)
+        if mime_type == utils.ImageMime.UNKNOWN:
+            raise Exception("unsupported file type")
+        dimensions = utils.get_img_dimensions(header)
+        if not dimensions and blob_info.size > len(header):
+            # jpeg with large exif data before the frame header
+            header = blobstore.fetch_data(blob_key, 0, min(blob_info.size, blobstore.MAX_BLOB_FETCH_SIZE) - 1)
+            dimensions = utils.get_img_dimensions(header)
+        if not dimensions:
+            img = images.Image(blobstore.BlobReader(blob_key).read())
+            dimensions = img.width, img.height
+        return mime_type, dimensions
+
+    @classmethod
+    def _new_photo(cls, photo_key_name, album_name, file_name, blob_key, size, mime_type, dimensions, **kwds):
+        photo = cls(key_name=photo_key_name, album_name=album_name, parent=DBAlbum.key_for(album_name), **kwds)
+        photo.photo_name = file_name
+        photo.sortkey = cls.new_sortkey()
+        photo.size = size
+        photo.mime = mime_type
+        photo.width, photo.height = dimensions
+        photo.blob_key = blob_key
+        photo.derivative_state = DerivativeState.PENDING
         return photo
 
     def to_dict(self):
@@ -482,10 +1262,364 @@ class DBPhoto(BaseModel):
             "height": self.height,
             "url": self.url,
             "thumb_url": self.thumb_url,
+            "thumb2x_url": self.thumb2x_url,
+            "medium_url": self.medium_url,
             "public": self.public,
+            "comment_count": self.comment_count,
             }
 
 
+class DBBackup(BaseModel):
+    key_template = "dbbackup/%(album_name)s/%(backup_id)s"
+    album_name = db.StringProperty()
+    backup_id = db.StringProperty()
+    since = db.DateTimeProperty() # None for a full backup
+    until = db.DateTimeProperty()
+    manifest = db.TextProperty()
+    parts_done = db.ListProperty(int)
+    createdate = db.DateTimeProperty(auto_now_add=True)
+
+    @classmethod
+    def create(cls, album, incremental=False, part_size=30*1024*1024):
+        """Splits the photos of album into parts of at most part_size bytes, only the photos
+        added after the last backup if incremental. Returns None if there is nothing to back up.
+        The blob and the name of a photo never change, createdate dates its content, updatedate
+        also moves with descriptions, comment counts and rendered derivatives."""
+        until = datetime.now()
+        since = incremental and album.lastbackupdate or None
+        photos, _cursor = album.get_photos(None)
+        if since:
+            photos = [photo for photo in photos if photo.createdate > since]
+        if not photos:
+            return None
+
+        parts = []
+        blob_infos = blobstore.BlobInfo.get([photo.blob_key for photo in photos])
+        for photo, blob_info in zip(photos, blob_infos):
+            if not blob_info:
+                continue
+            if not parts or parts[-1]["size"] + blob_info.size > part_size:
+                parts.append({"part": len(parts), "size": 0, "photos": []})
+            parts[-1]["size"] += blob_info.size
+            parts[-1]["photos"].append({
+                "key_name": photo.keyname,
+                "photo_name": photo.photo_name,
+                "size": blob_info.size,
+                "md5": blob_info.md5_hash,
+                "createdate": photo.createdate.isoformat(),
+                })
+        if not parts:
+            return None
+
+        # two backups started in the same second must not share a key
+        backup_id = "%s-%04x" % (until.strftime("%Y%m%d%H%M%S"), random.getrandbits(16))
+        backup = cls(key_name=cls.gen_key_name(album_name=album.name, backup_id=backup_id),
+                     album_name=album.name, backup_id=backup_id, since=since, until=until)
+        backup.manifest = json.dumps({
+            "album_name": album.name,
+            "backup_id": backup_id,
+            "since": since and since.isoformat() or None,
+            "until": until.isoformat(),
+            "parts": parts,
+            })
+        backup.save()
+        cls.expire(album.name, keep=backup)
+        return backup
+
+    @classmethod
+    def expire(cls, album_name, keep):
+        """Deletes the backups of album_name older than BACKUP_KEEP_DAYS and the unfinished
+        ones, but keep, the latest backup."""
+        cutoff = datetime.now() - timedelta(days=BACKUP_KEEP_DAYS)
+        expired = [backup.key() for backup in cls.all().filter("album_name =", album_name)
+                   if backup.key() != keep.key() and (not backup.finished or backup.createdate < cutoff)]
+        if expired:
+            db.delete(expired)
+            remove(expired)
+            logging.info("%d backups of album %s expired", len(expired), album_name)
+
+    @classmethod
+    def get_backup(cls, album_name, backup_id):
+        return cls.get_by_key_name(cls.gen_key_name(album_name=album_name, backup_id=backup_id))
+
+    @property
+    def parts(self):
+        manifest = getattr(self, "_manifest", None)
+        if manifest is None:
+            manifest = self._manifest = json.loads(self.manifest)
+        return manifest["parts"]
+
+    @property
+    def finished(self):
+        return len(set(self.parts_done)) >= len(self.parts)
+
+    def get_part_photos(self, part):
+        key_names = [photo["key_name"] for photo in self.parts[part]["photos"]]
+        return [photo for photo in DBPhoto.get_by_key_name(key_names) if photo]
+
+    def finish_part(self, part):
+        """Records a downloaded part, once all parts are done the album is backed up until the
+        manifest was created, photos changed during the download go to the next backup."""
+        def txn():
+            backup = DBBackup.get_by_key_name(self.keyname)
+            if part not in backup.parts_done:
+                backup.parts_done.append(part)
+                backup.save()
+            return backup.parts_done
+
+        self.parts_done = run_in_xg_transaction(txn)
+        if self.finished:
+            album = DBAlbum.get_album_by_name(self.album_name)
+            if album and (not album.lastbackupdate or album.lastbackupdate < self.until):
+                DBAlbum.set_last_backup_time(self.album_name, self.until)
+
+    def to_dict(self):
+        return {
+            "album_name": self.album_name,
+            "backup_id": self.backup_id,
+            "since": self.since and self.since.isoformat() or None,
+            "until": self.until.isoformat(),
+            "parts": self.parts,
+            "parts_done": self.parts_done,
+            }
+
+
+class DBBlobCollection(BaseModel):
+    """One run of the orphaned blob collector. The photos are walked first to index the blob
+    keys of photos saved before DBPhoto.blob_keys existed, then every blob older than the
+    grace period which no photo references is deleted, or only reported on a dry run."""
+    key_template = "dbblobcollection/%(collection_id)s"
+    collection_id = db.StringProperty()
+    dry_run = db.BooleanProperty(default=True)
+    cutoff = db.DateTimeProperty() # blobs created after it are left alone
+    state = db.StringProperty(default="photos") # photos, blobs, done
+    photos_checked = db.IntegerProperty(default=0)
+    photos_indexed = db.IntegerProperty(default=0)
+    blobs_checked = db.IntegerProperty(default=0)
+    orphan_count = db.IntegerProperty(default=0)
+    orphan_size = db.IntegerProperty(default=0)
+    deleted_count = db.IntegerProperty(default=0)
+    orphans = db.StringListProperty(indexed=False) # "blob_key size filename" of the first orphans
+    createdate = db.DateTimeProperty(auto_now_add=True)
+    finishdate = db.DateTimeProperty()
+
+    @classmethod
+    def start(cls, dry_run=True, grace=BLOB_COLLECTION_GRACE):
+        now = datetime.now()
+        # a dry run and a real run started in the same second must not share a key
+        collection_id = "%s-%04x" % (now.strftime("%Y%m%d%H%M%S"), random.getrandbits(16))
+        collection = cls(key_name=cls.gen_key_name(collection_id=collection_id), collection_id=collection_id,
+                         dry_run=dry_run, cutoff=now - timedelta(seconds=grace))
+        collection.save()
+        taskqueue.add(url=TASK_COLLECT_BLOBS_URL, params={"collection_id": collection_id})
+        return collection
+
+    @classmethod
+    def get_collection(cls, collection_id):
+        return cls.get_by_key_name(cls.gen_key_name(collection_id=collection_id))
+
+    def collect(self, cursor=None, batch=BLOB_COLLECTION_BATCH):
+        """Runs one batch of the current state, returns the cursor of the next batch or None when done."""
+        if self.state == "photos":
+            cursor = self._index_photos(cursor, batch)
+            if not cursor:
+                self.state = "blobs"
+        elif self.state == "blobs":
+            cursor = self._collect_blobs(cursor, batch)
+            if not cursor:
+                self.state = "done"
+                self.finishdate = datetime.now()
+                logging.info("blob collection %s done, %d orphans of %d bytes, %d deleted", self.collection_id,
+                             self.orphan_count, self.orphan_size, self.deleted_count)
+        self.save()
+        if self.state == "done":
+            return None
+        return cursor or ""
+
+    def _index_photos(self, cursor, batch):
+        query = db.Query(DBPhoto, keys_only=True)
+        query.with_cursor(start_cursor=cursor)
+        keys = query.fetch(batch)
+        stale = []
+        for entity in datastore.Get(keys):
+            if entity is not None and self._stale_blob_keys(entity) is not None:
+                stale.append(entity.key())
+
+        for key in stale:
+            # low level api, auto_now updatedate is kept
+            def txn():
+                entity = datastore.Get(key)
+                blob_keys = self._stale_blob_keys(entity)
+                if blob_keys:
+                    entity["blob_keys"] = blob_keys
+                    datastore.Put(entity)
+            db.run_in_transaction(txn)
+        remove(stale, content=False)
+        self.photos_checked += len(keys)
+        self.photos_indexed += len(stale)
+        if len(keys) < batch:
+            return None
+        return query.cursor()
+
+    @staticmethod
+    def _stale_blob_keys(entity):
+        """Returns the blob keys of a raw DBPhoto entity if blob_keys is out of date, else None."""
+        blob_keys = DBPhoto.from_entity(entity).all_blob_keys
+        indexed = entity.get("blob_keys") or []
+        if not isinstance(indexed, list):
+            indexed = [indexed]
+        if not blob_keys or sorted(indexed) == sorted(blob_keys):
+            return None
+        return blob_keys
+
+    def _collect_blobs(self, cursor, batch):
+        query = blobstore.BlobInfo.all().filter("creation <", self.cutoff)
+        query.with_cursor(start_cursor=cursor)
+        blob_infos = query.fetch(batch)
+        # keys only queries in parallel, run() sends the first batch rpc right away
+        queries = [DBPhoto.all(keys_only=True).filter("blob_keys =", str(blob_info.key())).run(limit=1)
+                   for blob_info in blob_infos]
+        orphans = [blob_info for blob_info, query_results in zip(blob_infos, queries)
+                   if next(iter(query_results), None) is None]
+
+        for blob_info in orphans[:BLOB_COLLECTION_REPORT_SIZE - len(self.orphans)]:
+            self.orphans.append(u"%s %d %s" % (blob_info.key(), blob_info.size, blob_info.filename or ""))
+        if orphans and not self.dry_run:
+            blobstore.delete([blob_info.key() for blob_info in orphans])
+            self.deleted_count += len(orphans)
+        self.blobs_checked += len(blob_infos)
+        self.orphan_count += len(orphans)
+        self.orphan_size += sum(blob_info.size for blob_info in orphans)
+        if len(blob_infos) < batch:
+            return None
+        return query.cursor()
+
+    def to_dict(self):
+        return {
+            "collection_id": self.collection_id,
+            "dry_run": self.dry_run,
+            "cutoff": self.cutoff.isoformat(),
+            "state": self.state,
+            "photos_checked": self.photos_checked,
+            "photos_indexed": self.photos_indexed,
+            "blobs_checked": self.blobs_checked,
+            "orphan_count": self.orphan_count,
+            "orphan_size": self.orphan_size,
+            "deleted_count": self.deleted_count,
+            "orphans": self.orphans,
+            "finishdate": self.finishdate and self.finishdate.isoformat() or None,
+            }
+
+
+class DBCommentCounterShard(db.Model):
+    """One of COMMENT_COUNTER_SHARDS shards of the comment count of a photo or an album, the
+    key name is the key name of the counted entity and the shard number. Every shard is its own
+    entity group, so comments of one album are counted without contention."""
+    count = db.IntegerProperty(default=0, indexed=False)
+
+def _comment_counter_keys(name):
+    return [db.Key.from_path(DBCommentCounterShard.kind(), "%s#%d" % (name, i))
+            for i in xrange(COMMENT_COUNTER_SHARDS)]
+
+def get_comment_counts(names):
+    """Returns {name: count} of the comments of photos or albums given by key name. The
+    aggregates are read from the request context and memcache, the shards of the missing
+    ones are summed up with one batch get."""
+    counts = cc_context.get("comment_counts")
+    if counts is None:
+        counts = cc_context.set("comment_counts", {})
+    missing = [name for name in set(names) if name not in counts]
+    if missing:
+        counts.update(memcache.get_multi(missing, key_prefix=COMMENT_COUNT_PREFIX))
+        missing = [name for name in missing if name not in counts]
+    if missing:
+        shards = db.get(sum([_comment_counter_keys(name) for name in missing], []))
+        summed = {}
+        for i, name in enumerate(missing):
+            summed[name] = sum([shard.count for shard in shards[i*COMMENT_COUNTER_SHARDS:(i+1)*COMMENT_COUNTER_SHARDS]
+                                if shard])
+        counts.update(summed)
+        try:
+            memcache.add_multi(summed, time=COMMENT_COUNT_TIME, key_prefix=COMMENT_COUNT_PREFIX)
+        except:
+            pass
+    return dict([(name, counts[name]) for name in names])
+
+def get_comment_count(name):
+    return get_comment_counts([name])[name]
+
+def add_comment_counts(deltas):
+    """Adds {name: delta} to one random shard of each counter, call it in the transaction
+    which writes the comments and offset_comment_counts() once that committed."""
+    for name, delta in deltas.items():
+        key = random.choice(_comment_counter_keys(name))
+        shard = db.get(key) or DBCommentCounterShard(key=key)
+        shard.count += delta
+        shard.put()
+
+def offset_comment_counts(deltas):
+    """Call it once the transaction which added {name: delta} committed. The aggregates are
+    deleted rather than offset, offsetting a missing key does nothing and a reader which summed
+    the shards before the commit would add its old sum right after."""
+    delete_comment_counts(deltas.keys(), shards=False)
+
+def set_comment_count(name, query):
+    """Overwrites the counter of name with the number of comments of the ancestor query, only
+    used to fill it from the comments. Counted and written in one transaction, a comment
+    added meanwhile makes it count again instead of being overwritten."""
+    keys = _comment_counter_keys(name)
+
+    def txn():
+        db.get(keys)
+        count = query.count(None)
+        db.put([DBCommentCounterShard(key=key, count=i == 0 and count or 0) for i, key in enumerate(keys)])
+
+    run_in_xg_transaction(txn)
+    delete_comment_counts([name], shards=False)
+
+def delete_comment_counts(names, shards=True):
+    if shards:
+        db.delete(sum([_comment_counter_keys(name) for name in names], []))
+    cc_context.set("comment_counts", None)
+    # the lock time blocks the add_multi of readers which summed the shards before the write
+    memcache.delete_multi(names, seconds=COMMENT_COUNT_LOCK_TIME, key_prefix=COMMENT_COUNT_PREFIX)
+    bump_content_generation(DBCommentCounterShard.kind())
+
+def count_comments(cursor=None, batch=5):
+    """Fills the comment counters of a batch of albums and their photos from the comments,
+    returns the cursor of the next batch or None when all albums are counted."""
+    query = DBAlbum.all()
+    query.with_cursor(start_cursor=cursor)
+    albums = query.fetch(batch)
+    for album in albums:
+        # comments live in the entity group of their album
+        album_key = DBAlbum.key_for(album.name)
+        comments = DBComment.all().ancestor(album_key).fetch(None)
+        set_comment_count(album.keyname, DBComment.all(keys_only=True).ancestor(album_key))
+        for photo_key_name in set([comment.photo_key_name for comment in comments]):
+            set_comment_count(photo_key_name, DBComment.all(keys_only=True).ancestor(album_key).filter(
+                "photo_key_name =", photo_key_name))
+    if len(albums) < batch:
+        return None
+    return query.cursor()
+
+def start_comment_count_migration():
+    if memcache.add("count_comments", 1, time=3600):
+        taskqueue.add(url=TASK_COUNT_COMMENTS_URL)
+
+def finish_comment_count_migration():
+    SITE_SETTINGS.save_settings(comments_counted=True)
+    load_site_settings()
+
+def start_derivative_backfill():
+    if memcache.add("backfill_derivatives", 1, time=3600):
+        taskqueue.add(url=TASK_BACKFILL_DERIVATIVES_URL)
+
+def finish_derivative_backfill():
+    SITE_SETTINGS.save_settings(derivatives_backfilled=True)
+    load_site_settings()
+
+
 class DBComment(BaseModel):
     photo_key_name = db.StringProperty(required=True) #photo_key_name
     author = db.StringProperty()
@@ -500,12 +1634,24 @@ class DBComment(BaseModel):
         photo = DBPhoto.get_by_key_name(key_name)
         if not photo:
             raise Exception("photo not exist")
-        comment = cls(parent=cls.db_parent, photo_key_name=key_name, content=content,
-            public=photo.public, **kwds)
-        comment.save()
-        photo.save()
+        comment = cls(parent=cls.parent_key(values={"photo_key_name": key_name}), photo_key_name=key_name,
+            content=content, public=photo.public, **kwds)
+        deltas = {key_name: 1, DBAlbum.gen_key_name(albumname=album_name): 1}
+
+        def txn():
+            comment.save()
+            add_comment_counts(deltas)
+
+        run_in_xg_transaction(txn)
+        offset_comment_counts(deltas)
         return comment
 
+    @classmethod
+    def parent_key(cls, key_name=None, values=None):
+        # comments live in the entity group of the album of their photo
+        album_name, photo_name = DBPhoto.get_names_from_key_name(values["photo_key_name"])
+        return DBAlbum.key_for(album_name)
+
     @classmethod
     def get_comments(cls, album_name, photo_name, public=True):
         photo_key_name = DBPhoto.gen_key_name(album_name=album_name, photo_name=photo_name)
@@ -514,32 +1660,88 @@ class DBComment(BaseModel):
         else:
             return cls.all().filter("photo_key_name =", photo_key_name)
 
+    @classmethod
+    def get_comments_page(cls, album_name, photo_name, public=True, pagesize=20, cursor=None):
+        """Returns a page of comments, newest first, and the cursor of the next page or None."""
+        query = cls.get_comments(album_name, photo_name, public).order("-date")
+        query.with_cursor(start_cursor=cursor)
+        comments = query.fetch(pagesize)
+        if len(comments) == pagesize:
+            return comments, query.cursor()
+        return comments, None
+
+    @classmethod
+    def get_comment_keys(cls, photo_key_names):
+        """Returns the keys of all comments of the photos, photos counted without comments are not queried."""
+        if SITE_SETTINGS.comments_counted:
+            counts = get_comment_counts(photo_key_names)
+            photo_key_names = [key_name for key_name in photo_key_names if counts[key_name]]
+        comment_keys = []
+        for i in xrange(0, len(photo_key_names), DELETE_ALBUM_BATCH):
+            comment_keys += cls.all(keys_only=True).filter(
+                "photo_key_name IN", photo_key_names[i:i + DELETE_ALBUM_BATCH]).fetch(None)
+        return comment_keys
+
     @classmethod
     def del_comments(cls, album_name, photo_name):
-        comment_keys = [comment.key() for comment in cls.get_comments(album_name, photo_name)]
-        remove(comment_keys)
-        db.delete(comment_keys)
+        photo_key_name = DBPhoto.gen_key_name(album_name=album_name, photo_name=photo_name)
+        comment_keys = cls.get_comment_keys([photo_key_name])
+        if not comment_keys:
+            return
+        deltas = {photo_key_name: -len(comment_keys), DBAlbum.gen_key_name(albumname=album_name): -len(comment_keys)}
+
+        def txn():
+            remove(comment_keys)
+            db.delete(comment_keys)
+            add_comment_counts(deltas)
+
+        run_in_xg_transaction(txn)
+        offset_comment_counts(deltas)
 
     @classmethod
     def del_comment_by_id(cls, comment_id):
-        comment = DBComment.get_by_id(comment_id)
+        """comment_id is the str key of the comment, or the numeric id of a legacy comment."""
+        if comment_id.isdigit():
+            comment = DBComment.get_by_id(long(comment_id), parent=LEGACY_PARENT)
+        else:
+            key = db.Key(comment_id)
+            comment = key.kind() == cls.kind() and get(key) or None
         if comment:
             photo_key_name = comment.photo_key_name
-            remove(comment.key())
-            comment.delete()
-            return DBPhoto.get_names_from_key_name(photo_key_name)
+            album_name, photo_name = DBPhoto.get_names_from_key_name(photo_key_name)
+            deltas = {photo_key_name: -1, DBAlbum.gen_key_name(albumname=album_name): -1}
+
+            def txn():
+                remove(comment.key())
+                comment.delete()
+                add_comment_counts(deltas)
+
+            run_in_xg_transaction(txn)
+            offset_comment_counts(deltas)
+            return album_name, photo_name
         return None
 
     @classmethod
     def get_latest_comments(cls, count, public=True):
-        if public:
-            query = cls.all().filter("public =", True)
-        else:
-            query = cls.all()
-        try:
-            return query.order("-date").fetch(count)
-        except:
-            return query.fetch(count)
+        return cls.get_latest_comments_async(count, public)()
+
+    @classmethod
+    def get_latest_comments_async(cls, count, public=True):
+        """Sends the query of get_latest_comments, returns a function which waits for its result."""
+        def query():
+            if public:
+                return cls.all().filter("public =", True)
+            return cls.all()
+        results = query().order("-date").run(limit=count, batch_size=count)
+
+        def get_result():
+            try:
+                comments = list(results)
+            except:
+                comments = query().fetch(count)
+            return [comment for comment in comments
+                    if SITE_SETTINGS.album_index.get(DBPhoto.get_names_from_key_name(comment.photo_key_name)[0])]
+        return get_result
 
     @property
     def avatar_url(self):
@@ -560,7 +1762,7 @@ class DBComment(BaseModel):
 
     def to_dict(self):
         return {
-            "id": self.id,
+            "id": self.str_key,
             "photo_key_name": self.photo_key_name,
             "photo_url": self.photo_url,
             "thumb_url": self.thumb_url,
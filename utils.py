@@ -62,6 +62,37 @@ def get_img_type(binary):
     else:
         return ImageMime.UNKNOWN
 
+_JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+
+def get_img_dimensions(binary):
+    """Returns (width, height) parsed from the image header, None if not found."""
+    import struct
+    mime_type = get_img_type(binary)
+    try:
+        if mime_type == ImageMime.PNG and binary[12:16] == "IHDR":
+            return struct.unpack(">LL", binary[16:24])
+        elif mime_type == ImageMime.GIF:
+            return struct.unpack("<HH", binary[6:10])
+        elif mime_type == ImageMime.BMP:
+            width, height = struct.unpack("<ll", binary[18:26])
+            return width, abs(height)
+        elif mime_type == ImageMime.JPEG:
+            index = 2
+            while index + 9 <= len(binary):
+                if binary[index] != "\xff":
+                    return None
+                marker = ord(binary[index + 1])
+                if marker == 0xFF:
+                    index += 1
+                    continue
+                if marker in _JPEG_SOF_MARKERS:
+                    height, width = struct.unpack(">HH", binary[index + 5:index + 9])
+                    return width, height
+                index += 2 + struct.unpack(">H", binary[index + 2:index + 4])[0]
+    except struct.error:
+        pass
+    return None
+
 def create_blob_file(mime_type, binary, filename="blob_filename"):
     from google.appengine.api import files
     blob_file_name = files.blobstore.create(mime_type=mime_type, _blobinfo_uploaded_filename=filename)